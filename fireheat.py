@@ -17,6 +17,7 @@ output_histogram = False
 mask_image_filename = None
 box_size = 256
 fire_clip = [2, 20]
+workers = resolver.workers
 
 parser = argparse.ArgumentParser(description='Make heatmap of local FIRE value from two super-resolved images', \
                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -36,6 +37,9 @@ parser.add_argument('-c', '--fire-clip', nargs=2, type=int, default=fire_clip, \
 parser.add_argument('-m', '--mask-image', nargs=1, default = [mask_image_filename], \
                     help='read masking image to omit unnecessary area')
 
+parser.add_argument('-j', '--workers', nargs=1, type=int, default=[workers], \
+                    help='number of processes to calculate local FIRE')
+
 parser.add_argument('-G', '--output-histogram', action='store_true', default=output_histogram, \
                     help='output histogram TIFF image')
 parser.add_argument('-g', '--output-histogram-file', nargs=1, default = [output_histogram_filename], \
@@ -57,6 +61,7 @@ box_size = args.box_size[0]
 mask_image_filename = args.mask_image[0]
 
 fire_clip = args.fire_clip
+resolver.workers = args.workers[0]
 
 image1 = tifffile.imread(input_filename1)
 image2 = tifffile.imread(input_filename2)
@@ -71,7 +76,7 @@ size_x = image1.shape[1] // (box_size // 2) - 1
 size_y = image2.shape[0] // (box_size // 2) - 1
 
 # prepare masking
-# masking array for fire_array
+# masking array for fire_array (boxes with more than 10% of masked pixels are omitted)
 mask_array = numpy.ones((size_y, size_x), dtype=int)
 if mask_image_filename is not None:
     # read masking image
@@ -80,44 +85,12 @@ if mask_image_filename is not None:
     # mask image
     image1 = image1 * mask_image
     image2 = image2 * mask_image
-    for index_y in range(size_y):
-        for index_x in range(size_x):
-            # origin to copy image
-            x0 = (box_size // 2) * index_x
-            y0 = (box_size // 2) * index_y
-            #mask_array[index_y, index_x] = numpy.prod(mask_image[y0:(y0 + 128), x0:(x0 + 128)])
-            total = mask_image[y0:(y0 + box_size), x0:(x0 + box_size)].size
-            masked = numpy.sum(mask_image[y0:(y0 + box_size), x0:(x0 + box_size)] == 0)
-            if 1.0 * masked / total > 0.1:
-                mask_array[index_y, index_x] = 0
-
-fire_array = numpy.zeros((size_y, size_x), dtype=float)
-image1_box = numpy.zeros((box_size, box_size), dtype=int)
-image2_box = numpy.zeros((box_size, box_size), dtype=int)
+    mask_array[resolver.mask_coverage(mask_image, box_size) > 0.1] = 0
 
-for index_y in range(size_y):
-    for index_x in range(size_x):
-        # origin to copy image
-        x0 = (box_size // 2) * index_x
-        y0 = (box_size // 2) * index_y
-
-        image1_box = image1[y0:(y0 + box_size), x0:(x0 + box_size)]
-        image2_box = image2[y0:(y0 + box_size), x0:(x0 + box_size)]
-
-        # calculate fire only for unmasked area (to prevent zero error)
-        if mask_array[index_y, index_x] == 0:
-            fire_array[index_y, index_x] = numpy.nan
-        else:
-            sf, fsc = resolver.fourier_spin_correlation(image1_box, image2_box)
-            smooth_fsc = resolver.smoothing_fsc(sf, fsc)
-            sf_fix17 = resolver.intersection_threshold(sf, smooth_fsc)
-
-            if len(sf_fix17) > 0:
-                fire_array[index_y, index_x] = 2.0 / sf_fix17[0]
-            else:
-                print("fire not determined at index = (%d, %d)" % (index_x, index_y))
-                print(smooth_fsc)
-                fire_array[index_y, index_x] = numpy.nan
+# calculate fire only for unmasked area (to prevent zero error)
+fire_array, determined_array = resolver.local_fire(image1, image2, box_size, mask_array)
+for index_y, index_x in zip(*numpy.nonzero((determined_array == False) & (mask_array != 0))):
+    print("fire not determined at index = (%d, %d)" % (index_x, index_y))
 
 print("mean fire: %f (min: %f, max %f)" % (numpy.nanmean(fire_array), numpy.nanmin(fire_array), numpy.nanmax(fire_array)))
 
@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 
 import os, platform, sys, glob, argparse, time
-import pandas, numpy, tifffile
+import pandas, numpy
 from taniclass import spotplotter, spotfilter
 
-# prepare classes
+# prepare classes (a plotter for each image)
 plotter = spotplotter.SpotPlotter()
+plotter2 = spotplotter.SpotPlotter()
 filter = spotfilter.SpotFilter()
 
 # defaults
@@ -35,8 +36,19 @@ parser.add_argument('-a', '--align-file', nargs=1, default=[align_filename], \
 parser.add_argument('-e', '--align-each', nargs=1, type=int, default=[plotter.align_each], \
                     help='alignment correction every X plane')
 
+parser.add_argument('-D', '--drift-model', nargs=1, default=[plotter.drift_model], \
+                    choices = plotter.drift_models, \
+                    help='drift of each spot (step: constant every X frames, linear or spline: interpolated)')
+
 parser.add_argument('-X', '--image-scale', nargs=1, type=int, default=[plotter.image_scale], \
                     help='scale factor to original image')
+parser.add_argument('-p', '--plot-mode', nargs=1, default=[plotter.plot_mode], \
+                    choices = plotter.plot_modes, \
+                    help='plot each spot as a pixel (point) or as normalized splats at subpixel positions (bilinear, gaussian)')
+parser.add_argument('-k', '--splat-sigma', nargs=1, type=float, default=[plotter.splat_sigma], \
+                    help='sigma of gaussian splats (pixel of the original image)')
+parser.add_argument('-K', '--splat-column', nargs=1, default=[plotter.splat_column], \
+                    help='column of spot tables used as sigma of gaussian splats (instead of -k)')
 parser.add_argument('-Z', '--image-size', nargs=2, type=int, default=image_size, \
                     metavar=('WIDTH', 'HEIGHT'), \
                     help='size of original image (read from first file if not specified)')
@@ -82,8 +94,12 @@ output_filename2 = output_prefix + '_2.tif'
 align_spots = (args.no_align is False)
 align_filename = args.align_file[0]
 image_size = args.image_size
-plotter.align_each = args.align_each[0]
-plotter.image_scale = args.image_scale[0]
+plotter.align_each = plotter2.align_each = args.align_each[0]
+plotter.drift_model = plotter2.drift_model = args.drift_model[0]
+plotter.image_scale = plotter2.image_scale = args.image_scale[0]
+plotter.plot_mode = plotter2.plot_mode = args.plot_mode[0]
+plotter.splat_sigma = plotter2.splat_sigma = args.splat_sigma[0]
+plotter.splat_column = plotter2.splat_column = args.splat_column[0]
 consolidate_spots = args.consolidate_spots
 lifetime_range = args.lifetime_range
 
@@ -93,6 +109,7 @@ if align_spots is True:
     print("Using %s for alignment." % (align_filename))
 else:
     align_table = None
+drift = plotter.fit_drift(align_table)
 
 # read first table and determine size
 if image_size is None:
@@ -101,8 +118,8 @@ else:
     width, height = image_size[0], image_size[1]
 
 # prepare output image
-output_image1 = numpy.zeros((height * plotter.image_scale, width * plotter.image_scale), dtype=numpy.int64)
-output_image2 = numpy.zeros((height * plotter.image_scale, width * plotter.image_scale), dtype=numpy.int64)
+output_image1 = plotter.init_image(width, height)
+output_image2 = plotter2.init_image(width, height)
 
 # plot spots for each table
 last_plane = 0
@@ -118,7 +135,7 @@ for index, input_filename in enumerate(input_filenames):
         total_spots = len(spot_table)
         filter.lifetime_min = lifetime_range[0]
         filter.lifetime_max = numpy.inf if lifetime_range[1] == 0 else lifetime_range[1]
-        spot_table = filter.filter_spots_lifetime(spot_table)
+        spot_table = filter.filter_spots_lifetime(spot_table, params.get('sorted_by_track'))
         if lifetime_range[1] == 0:
             print("Filtered %d of %d spots (%d %f)." % \
                     (total_spots - len(spot_table), total_spots, filter.lifetime_min, filter.lifetime_max))
@@ -139,10 +156,10 @@ for index, input_filename in enumerate(input_filenames):
 
     # plot
     if input_filename in input_filenames1:
-        output_image1 = plotter.plot_spots(output_image1, last_plane, spot_table, align_table)
+        plotter.plot_spots(last_plane, spot_table, drift)
         print("1: Plot %d spots (%d planes) from %s." % (len(spot_table), params['total_planes'], input_filename))
     else:
-        output_image2 = plotter.plot_spots(output_image2, last_plane, spot_table, align_table)
+        plotter2.plot_spots(last_plane, spot_table, drift)
         print("2: Plot %d spots (%d planes) from %s." % (len(spot_table), params['total_planes'], input_filename))
 
     last_plane += params['total_planes']
@@ -151,9 +168,7 @@ for index, input_filename in enumerate(input_filenames):
 
 # clip output.tif to 32bit and output
 print("Output image file to %s." % (output_filename1))
-output_image_32bit = output_image1.clip(0, numpy.iinfo(numpy.int32).max).astype(numpy.int32)
-tifffile.imwrite(output_filename1, output_image_32bit)
+plotter.write_images(output_filename1, output_image1)
 
 print("Output image file to %s." % (output_filename2))
-output_image_32bit = output_image2.clip(0, numpy.iinfo(numpy.int32).max).astype(numpy.int32)
-tifffile.imwrite(output_filename2, output_image_32bit)
+plotter2.write_images(output_filename2, output_image2)
@@ -2,7 +2,7 @@
 
 import os, platform, sys, glob, argparse
 import numpy, tifffile
-from taniclass import akaze
+from taniclass import akaze, imagesource
 from PIL import Image
 
 # prepare aligner
@@ -56,23 +56,13 @@ if args.output_image_file is None:
 else:
     output_image_filename = args.output_image_file[0]
 
-# read input image(s)
-image_list = []
-for input_filename in input_filenames:
-    images = tifffile.imread(input_filename)
-    if len(images.shape) == 2:
-        image_list += [images]
-    else:
-        image_list += [images[i] for i in range(len(images))]
-
-orig_images = numpy.asarray(image_list)
+# open input image(s) as one sequence of planes
+orig_images = imagesource.ImageSource(input_filenames)
 
 # read reference image
 reference_image = None
 if reference_image_filename is not None:
-    reference_image = tifffile.imread(reference_image_filename)
-    if len(reference_image.shape) > 2:
-        reference_image = reference_image[0]
+    reference_image = imagesource.ImageSource(reference_image_filename)[0]
 
 # alignment
 results = aligner.calculate_alignments(orig_images, reference_image)
@@ -90,7 +80,7 @@ print("Output alignment tsv file to %s." % (output_tsv_filename))
 
 # output image
 if output_image is True:
-    images_uint8 = aligner.convert_to_uint8(orig_images)
+    images_uint8 = aligner.convert_to_uint8(orig_images.asarray())
 
     output_image_array = numpy.zeros(images_uint8.shape, dtype=numpy.uint8)
 
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+import sys, io, argparse, time, numpy, pandas
+from taniclass import gridindex, gaussian8, nnchaser, spotstream
+
+# defaults
+image_size = [512, 512]
+densities = [0.001, 0.01, 0.05]
+search_radius = 3.0
+repeat_count = 5
+random_seed = 0
+stream_planes = 0
+stream_spots = 100
+spill_size = spotstream.SpotStream(None).spill_size
+
+# parse arguments
+parser = argparse.ArgumentParser(description='benchmark neighbor search of spots (grid index, cKDTree and scikit-learn).', \
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('-s', '--image-size', nargs=2, type=int, default=image_size, \
+                    metavar=('WIDTH', 'HEIGHT'), help='size of the area to place spots')
+parser.add_argument('-d', '--densities', nargs='+', type=float, default=densities, \
+                    help='densities of spots (spots per pixel)')
+parser.add_argument('-r', '--search-radius', nargs=1, type=float, default=[search_radius], \
+                    help='radius to search neighbors (chase_distance or dup_threshold)')
+parser.add_argument('-n', '--repeat-count', nargs=1, type=int, default=[repeat_count], \
+                    help='number of repeats (the best time is shown)')
+parser.add_argument('-e', '--random-seed', nargs=1, type=int, default=[random_seed], \
+                    help='seed of random numbers')
+parser.add_argument('-S', '--stream-planes', nargs=1, type=int, default=[stream_planes], \
+                    help='planes of a synthetic movie to check streaming, where one track lasts the whole movie (0 to skip)')
+parser.add_argument('-p', '--stream-spots', nargs=1, type=int, default=[stream_spots], \
+                    help='short-lived spots per plane of the synthetic movie')
+parser.add_argument('-l', '--spill-size', nargs=1, type=int, default=[spill_size], \
+                    help='finished spots held back in memory before they are spilled')
+args = parser.parse_args()
+
+# set arguments
+image_size = args.image_size
+densities = args.densities
+search_radius = args.search_radius[0]
+repeat_count = args.repeat_count[0]
+random_seed = args.random_seed[0]
+stream_planes = args.stream_planes[0]
+stream_spots = args.stream_spots[0]
+spill_size = args.spill_size[0]
+
+# optional libraries
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+try:
+    from sklearn.neighbors import NearestNeighbors
+except ImportError:
+    NearestNeighbors = None
+
+def best_time (function):
+    times = []
+    for count in range(repeat_count):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+def grid_nearest (orig_xy, next_xy):
+    return gridindex.GridIndex(next_xy, search_radius).nearest(orig_xy)[0]
+
+def ckdtree_nearest (orig_xy, next_xy):
+    distances, targets = cKDTree(next_xy).query(orig_xy, distance_upper_bound = search_radius)
+    targets[distances > search_radius] = -1
+    return targets
+
+def sklearn_nearest (orig_xy, next_xy):
+    distances, targets = NearestNeighbors(n_neighbors = 1, metric = 'euclidean').fit(next_xy).kneighbors(orig_xy)
+    targets, distances = targets.flatten(), distances.flatten()
+    targets[distances > search_radius] = -1
+    return targets
+
+def grid_pairs (orig_xy, next_xy):
+    return len(gridindex.GridIndex(orig_xy, search_radius).all_pairs()[0])
+
+def ckdtree_pairs (orig_xy, next_xy):
+    return len(cKDTree(orig_xy).query_pairs(search_radius, output_type = 'ndarray'))
+
+def sklearn_pairs (orig_xy, next_xy):
+    targets = NearestNeighbors(radius = search_radius).fit(orig_xy).radius_neighbors(orig_xy, return_distance = False)
+    return (sum([len(target) for target in targets]) - len(orig_xy)) // 2
+
+# benchmark
+rng = numpy.random.default_rng(random_seed)
+print("Area: %d x %d, radius: %f, best of %d" % (image_size[0], image_size[1], search_radius, repeat_count))
+print("%-10s %-8s %-9s %12s %12s %12s" % ('density', 'spots', 'query', 'grid (ms)', 'ckdtree (ms)', 'sklearn (ms)'))
+
+for density in densities:
+    spot_count = int(density * image_size[0] * image_size[1])
+    orig_xy = rng.uniform(0, 1, (spot_count, 2)) * image_size
+    next_xy = orig_xy + rng.normal(0, search_radius / 2, orig_xy.shape)
+
+    for query, functions in [['nearest', [grid_nearest, ckdtree_nearest, sklearn_nearest]], \
+                             ['pairs', [grid_pairs, ckdtree_pairs, sklearn_pairs]]]:
+        times = []
+        results = []
+        for function, library in zip(functions, [gridindex, cKDTree, NearestNeighbors]):
+            if library is None:
+                times.append(numpy.nan)
+                continue
+            elapsed, result = best_time(lambda: function(orig_xy, next_xy))
+            times.append(elapsed * 1000)
+            results.append(result)
+
+        # results should agree (except for ties of distances)
+        if any([numpy.any(result != results[0]) for result in results]):
+            print("Results disagree: density %f, query %s" % (density, query), file = sys.stderr)
+
+        print("%-10g %-8d %-9s %12.3f %12.3f %12.3f" % (density, spot_count, query, times[0], times[1], times[2]))
+
+# streaming check: a spot stays at the corner through the movie, so its track is the oldest
+# active track until the end and the other tracks are held back (or spilled) by the streamer
+class SyntheticTracer:
+    def __init__ (self, plane_results):
+        self.columns = gaussian8.Gaussian8().columns
+        self.workers = 1
+        self.plane_results = plane_results
+
+    def fitting_plane (self, input_image, index, thread_data):
+        return dict(self.plane_results[index]), {}
+
+if stream_planes > 0:
+    plane_results = []
+    for plane in range(stream_planes):
+        spot_x = numpy.concatenate([[2.0], rng.uniform(16, image_size[0], stream_spots)])
+        spot_y = numpy.concatenate([[2.0], rng.uniform(16, image_size[1], stream_spots)])
+        plane_results.append({'plane': numpy.full(len(spot_x), plane), 'index': numpy.arange(len(spot_x)), \
+                              'x': spot_x, 'y': spot_y, 'diameter': numpy.full(len(spot_x), 2.0), \
+                              'intensity': numpy.full(len(spot_x), 100), 'fit_error': numpy.zeros(len(spot_x)), \
+                              'chi_square': numpy.zeros(len(spot_x))})
+
+    # chase all spots at once
+    chaser = nnchaser.NNChaser()
+    start = time.perf_counter()
+    spot_table = pandas.concat([pandas.DataFrame(result) for result in plane_results], ignore_index = True)
+    spot_table['total_index'] = numpy.arange(len(spot_table))
+    spot_table = chaser.chase_spots(spot_table[SyntheticTracer([]).columns])
+    batch_tsv = spot_table.to_csv(sep='\t', index = False, header = False)
+    batch_time = time.perf_counter() - start
+
+    # stream
+    streamer = spotstream.SpotStream(SyntheticTracer(plane_results), chaser)
+    streamer.spill_size = spill_size
+    stream_file = io.StringIO()
+    start = time.perf_counter()
+    streamer.run([numpy.zeros((1, 1))] * stream_planes, stream_file)
+    stream_time = time.perf_counter() - start
+
+    print("Stream: %d planes, %d spots, batch %.3f s, stream %.3f s" % \
+          (stream_planes, len(spot_table), batch_time, stream_time))
+    print("Held at most %d finished spots in memory (spill size %d, chunk size %d, %d runs spilled)" % \
+          (streamer.max_held_spots, spill_size, streamer.chunk_size, streamer.spilled_runs))
+
+    if stream_file.getvalue() != batch_tsv:
+        print("Results disagree: streaming and batch", file = sys.stderr)
+    if streamer.max_held_spots > spill_size + streamer.chunk_size + stream_spots + 1:
+        print("Held spots exceed the spill size and the chunk size", file = sys.stderr)
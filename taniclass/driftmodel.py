@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+import sys, numpy
+from scipy.interpolate import CubicSpline
+
+class DriftModel:
+    def __init__ (self, align_table, align_each = 500, model = 'step'):
+        # drift of each block of align_each planes (align_plane is the index of blocks).
+        # step: constant in each block, linear or spline: interpolated between the centers of blocks
+        self.models = ['step', 'linear', 'spline']
+        if model not in self.models:
+            raise Exception('unknown drift model')
+        if len(align_table) == 0:
+            raise Exception('alignment table is empty')
+
+        self.model = model
+        self.align_each = align_each
+
+        order = numpy.argsort(align_table['align_plane'].values, kind = 'stable')
+        self.align_planes = align_table['align_plane'].values[order].astype(int)
+        self.align_x = align_table['align_x'].values[order].astype(float)
+        self.align_y = align_table['align_y'].values[order].astype(float)
+
+        # samples of continuous models at the centers of blocks
+        self.sample_planes = self.align_planes * align_each + (align_each - 1) / 2.0
+        if (self.model == 'spline') and (len(self.sample_planes) > 2):
+            self.spline = CubicSpline(self.sample_planes, numpy.array([self.align_x, self.align_y]).T, axis = 0)
+        else:
+            self.spline = None
+
+    def offsets (self, planes):
+        # drift (x, y) at planes counted through all files
+        planes = numpy.asarray(planes)
+        if self.model == 'step':
+            # NaN for blocks without drift
+            blocks = planes // self.align_each
+            positions = numpy.clip(numpy.searchsorted(self.align_planes, blocks), 0, len(self.align_planes) - 1)
+            found = (self.align_planes[positions] == blocks)
+            return numpy.where(found, self.align_x[positions], numpy.nan), numpy.where(found, self.align_y[positions], numpy.nan)
+        elif self.spline is None:
+            # linear (constant outside samples)
+            return numpy.interp(planes, self.sample_planes, self.align_x), numpy.interp(planes, self.sample_planes, self.align_y)
+        else:
+            # spline (constant outside samples)
+            offsets = self.spline(numpy.clip(planes, self.sample_planes[0], self.sample_planes[-1]))
+            return offsets[:, 0], offsets[:, 1]
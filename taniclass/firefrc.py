@@ -5,39 +5,72 @@
 # - fourier_ring_corr.py
 # by Sajid Ari (https://github.com/s-sajid-ali/FRC)
 
-import sys, numpy
+import sys, collections, multiprocessing, numpy
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import statsmodels.nonparametric.smoothers_lowess as smoothers_lowess
 
 class FireFRC:
     def __init__ (self):
-        pass
-
-    def spin_average (self, fft_image):
-        #numpy.set_printoptions(threshold=numpy.inf)
-
-        shape = numpy.shape(fft_image)
-        if len(shape) != 2:
-            raise Exception('input_image must be 2d image array')
+        self.ring_maps = collections.OrderedDict() # ring maps of image shapes (least recently used first)
+        self.max_ring_maps = 8
+        self.block_rows = 256 # rows of spectra reduced at once
+        self.batch_pixels = 4194304 # pixels of boxes transformed at once for local FIRE
+        self.workers = 1 # number of processes to calculate local FIRE
+
+    def ring_map (self, shape):
+        # ring (rounded distance from the center) of each pixel and the number of pixels in each ring
+        shape = tuple(shape)
+        if shape in self.ring_maps:
+            self.ring_maps.move_to_end(shape)
+            return self.ring_maps[shape]
 
         height, width = shape
         x = numpy.arange(width) - numpy.floor(width / 2)
         y = numpy.arange(height) - numpy.floor(height / 2)
+        rings = numpy.round(numpy.sqrt(y[:, numpy.newaxis] ** 2 + x[numpy.newaxis, :] ** 2)).astype(numpy.intp)
+        ring_counts = numpy.bincount(rings.ravel())
 
-        [y_grid, x_grid] = numpy.meshgrid(y, x)
+        self.ring_maps[shape] = (rings, ring_counts)
+        if len(self.ring_maps) > self.max_ring_maps:
+            self.ring_maps.popitem(last = False)
 
-        indexes = numpy.round(numpy.sqrt(y_grid * y_grid + x_grid * x_grid)).astype(int)
-        fft_sum = numpy.zeros(numpy.max(indexes) + 1, dtype = numpy.complex)
-        fft_count = numpy.zeros(numpy.max(indexes) + 1, dtype = numpy.complex )
+        return rings, ring_counts
 
-        for index in range(numpy.max(indexes) + 1):
-            array_to_apply = numpy.where(indexes == index)
-            fft_sum[index] = numpy.sum(fft_image[array_to_apply])
-            fft_count[index] = numpy.shape(array_to_apply)[1]
+    def spin_average (self, fft_image):
+        shape = numpy.shape(fft_image)
+        if len(shape) != 2:
+            raise Exception('input_image must be 2d image array')
 
-        return fft_sum / fft_count
+        rings, ring_counts = self.ring_map(shape)
+        fft_image = numpy.asarray(fft_image)
+        fft_sum = numpy.bincount(rings.ravel(), weights = fft_image.real.ravel(), minlength = len(ring_counts))
+        if numpy.iscomplexobj(fft_image):
+            fft_sum = fft_sum + 1j * numpy.bincount(rings.ravel(), weights = fft_image.imag.ravel(), minlength = len(ring_counts))
+
+        return fft_sum / ring_counts
+
+    def spin_spectra (self, image_fft1, image_fft2):
+        # spin averages of fft1 * conj(fft2), |fft1|^2 and |fft2|^2 reduced in a pass over blocks of rows
+        rings, ring_counts = self.ring_map(numpy.shape(image_fft1))
+        ring_count = len(ring_counts)
+        spectrum_offsets = (numpy.arange(4) * ring_count)[:, numpy.newaxis, numpy.newaxis]
+
+        spectrum_sums = numpy.zeros(4 * ring_count)
+        for start in range(0, len(rings), self.block_rows):
+            fft1 = image_fft1[start:(start + self.block_rows)]
+            fft2 = image_fft2[start:(start + self.block_rows)]
+            product = fft1 * numpy.conj(fft2)
+            weights = numpy.array([product.real, product.imag, \
+                                   fft1.real * fft1.real + fft1.imag * fft1.imag, \
+                                   fft2.real * fft2.real + fft2.imag * fft2.imag])
+            indexes = rings[start:(start + self.block_rows)][numpy.newaxis] + spectrum_offsets
+            spectrum_sums += numpy.bincount(indexes.ravel(), weights = weights.ravel(), minlength = 4 * ring_count)
+
+        spectrum_sums = spectrum_sums.reshape(4, ring_count) / ring_counts
+        return spectrum_sums[0] + 1j * spectrum_sums[1], spectrum_sums[2], spectrum_sums[3]
 
     def fourier_spin_correlation (self, image_array1, image_array2):
-        if numpy.shape(image_array1) != numpy.shape(image_array1):
+        if numpy.shape(image_array1) != numpy.shape(image_array2):
             raise Exception('input images must have the same dimensions')
 
         if numpy.shape(image_array1)[0] != numpy.shape(image_array1)[1]:
@@ -47,9 +80,7 @@ class FireFRC:
         image_fft2 = numpy.fft.fftshift(numpy.fft.fft2(image_array2))
 
         #I1 and I2 store the DFT of the images to be used in the calcuation for the FSC
-        spin_12 = self.spin_average(numpy.multiply(image_fft1, numpy.conj(image_fft2)))
-        spin_11 = self.spin_average(numpy.multiply(image_fft1, numpy.conj(image_fft1)))
-        spin_22 = self.spin_average(numpy.multiply(image_fft2, numpy.conj(image_fft2)))
+        spin_12, spin_11, spin_22 = self.spin_spectra(image_fft1, image_fft2)
 
         fsc = numpy.abs(spin_12) / numpy.sqrt(numpy.abs(spin_11 * spin_22))
         sf = 2 * numpy.arange(numpy.shape(spin_12)[0]) / numpy.shape(image_array1)[0]
@@ -74,3 +105,141 @@ class FireFRC:
             sf_crosses.append(sf_cross)
 
         return numpy.array(sf_crosses)
+
+    def box_views (self, image, box_size):
+        # half-overlapping boxes as strided views (rows of boxes, columns of boxes, box_size, box_size)
+        step = box_size // 2
+        size_y, size_x = image.shape[0] // step - 1, image.shape[1] // step - 1
+        boxes = numpy.lib.stride_tricks.sliding_window_view(image, (box_size, box_size))[::step, ::step]
+        return boxes[:size_y, :size_x]
+
+    def mask_coverage (self, mask_image, box_size):
+        # fraction of masked (zero) pixels in each box using an integral image
+        step = box_size // 2
+        height, width = mask_image.shape
+        size_y, size_x = height // step - 1, width // step - 1
+
+        integral = numpy.zeros((height + 1, width + 1), dtype=numpy.int64)
+        integral[1:, 1:] = (mask_image == 0).cumsum(axis = 0).cumsum(axis = 1)
+
+        y0 = numpy.arange(size_y)[:, numpy.newaxis] * step
+        x0 = numpy.arange(size_x)[numpy.newaxis, :] * step
+        masked = integral[y0 + box_size, x0 + box_size] - integral[y0, x0 + box_size] - \
+                 integral[y0 + box_size, x0] + integral[y0, x0]
+
+        return masked / (box_size * box_size)
+
+    def half_ring_map (self, box_size):
+        # rings of the half spectrum of real FFTs (not shifted) and weights of columns.
+        # columns except for the zero (and nyquist) frequency stand for their mirrored columns
+        key = ('half', box_size)
+        if key in self.ring_maps:
+            self.ring_maps.move_to_end(key)
+            return self.ring_maps[key]
+
+        y = numpy.fft.fftfreq(box_size) * box_size
+        x = numpy.arange(box_size // 2 + 1)
+        rings = numpy.round(numpy.sqrt(y[:, numpy.newaxis] ** 2 + x[numpy.newaxis, :] ** 2)).astype(numpy.intp)
+        column_weights = numpy.full(len(x), 2.0)
+        column_weights[0] = 1.0
+        if box_size % 2 == 0:
+            column_weights[-1] = 1.0
+        ring_counts = numpy.bincount(rings.ravel(), weights = numpy.broadcast_to(column_weights, rings.shape).ravel())
+
+        self.ring_maps[key] = (rings, column_weights, ring_counts)
+        if len(self.ring_maps) > self.max_ring_maps:
+            self.ring_maps.popitem(last = False)
+
+        return rings, column_weights, ring_counts
+
+    def box_correlation (self, boxes1, boxes2):
+        # fsc of boxes (boxes, box_size, box_size) using batched real FFTs.
+        # spectra are real for real images (imaginary parts of mirrored frequencies cancel)
+        box_count, box_size = len(boxes1), boxes1.shape[-1]
+        rings, column_weights, ring_counts = self.half_ring_map(box_size)
+        ring_count = len(ring_counts)
+
+        fft1 = numpy.fft.rfft2(numpy.asarray(boxes1, dtype = float))
+        fft2 = numpy.fft.rfft2(numpy.asarray(boxes2, dtype = float))
+        indexes = (rings[numpy.newaxis] + (numpy.arange(box_count) * ring_count)[:, numpy.newaxis, numpy.newaxis]).ravel()
+
+        spectra = []
+        for values in [fft1.real * fft2.real + fft1.imag * fft2.imag, \
+                       fft1.real * fft1.real + fft1.imag * fft1.imag, \
+                       fft2.real * fft2.real + fft2.imag * fft2.imag]:
+            sums = numpy.bincount(indexes, weights = (values * column_weights).ravel(), minlength = box_count * ring_count)
+            spectra.append(sums.reshape(box_count, ring_count) / ring_counts)
+
+        with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+            fsc = numpy.abs(spectra[0]) / numpy.sqrt(numpy.abs(spectra[1] * spectra[2]))
+        sf = 2 * numpy.arange(ring_count) / box_size
+
+        return sf, fsc
+
+    def fire_batch (self, task):
+        # FIRE of a batch of boxes and whether FSC crossed the threshold (NaN if not determined)
+        boxes1, boxes2 = task
+        sf, fsc = self.box_correlation(boxes1, boxes2)
+
+        fires = numpy.full(len(fsc), numpy.nan)
+        determined = numpy.zeros(len(fsc), dtype=bool)
+        for index in range(len(fsc)):
+            smooth_fsc = self.smoothing_fsc(sf, fsc[index])
+            sf_fix17 = self.intersection_threshold(sf, smooth_fsc)
+            if len(sf_fix17) > 0:
+                fires[index] = 2.0 / sf_fix17[0]
+                determined[index] = True
+
+        return fires, determined
+
+    def map_batches (self, tasks):
+        # results in the order of tasks. processes are forked if possible (threads otherwise).
+        # tasks submitted at once are limited to keep memory bounded
+        if self.workers <= 1:
+            for task in tasks:
+                yield self.fire_batch(task)
+            return
+
+        if 'fork' in multiprocessing.get_all_start_methods():
+            executor = ProcessPoolExecutor(max_workers = self.workers, mp_context = multiprocessing.get_context('fork'))
+        else:
+            executor = ThreadPoolExecutor(max_workers = self.workers)
+
+        with executor:
+            futures = collections.deque()
+            for task in tasks:
+                futures.append(executor.submit(self.fire_batch, task))
+                if len(futures) >= 2 * self.workers:
+                    yield futures.popleft().result()
+            while len(futures) > 0:
+                yield futures.popleft().result()
+
+    def local_fire (self, image1, image2, box_size, box_mask = None):
+        # FIRE of half-overlapping boxes (rows of boxes, columns of boxes) and whether it was determined.
+        # NaN for boxes out of box_mask or not determined
+        if numpy.shape(image1) != numpy.shape(image2):
+            raise Exception('input images must have the same dimensions')
+
+        views1 = self.box_views(image1, box_size)
+        views2 = self.box_views(image2, box_size)
+        size_y, size_x = views1.shape[0:2]
+
+        if box_mask is None:
+            targets = numpy.arange(size_y * size_x)
+        else:
+            targets = numpy.flatnonzero(numpy.asarray(box_mask).ravel())
+
+        # batches of boxes copied from the views
+        batch_boxes = max(1, self.batch_pixels // (box_size * box_size))
+        def batch_tasks ():
+            for start in range(0, len(targets), batch_boxes):
+                index_y, index_x = numpy.divmod(targets[start:(start + batch_boxes)], size_x)
+                yield views1[index_y, index_x], views2[index_y, index_x]
+
+        fire_array = numpy.full(size_y * size_x, numpy.nan)
+        determined_array = numpy.zeros(size_y * size_x, dtype=bool)
+        for start, (fires, determined) in zip(range(0, len(targets), batch_boxes), self.map_batches(batch_tasks())):
+            fire_array[targets[start:(start + len(fires))]] = fires
+            determined_array[targets[start:(start + len(fires))]] = determined
+
+        return fire_array.reshape(size_y, size_x), determined_array.reshape(size_y, size_x)
@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 
-import os, sys, numpy, pandas, time
+import os, sys, numpy, pandas, time, threading
 import scipy.ndimage as ndimage
 from skimage.feature import peak_local_max
-from sklearn.neighbors import NearestNeighbors
+from scipy.spatial import cKDTree
+from concurrent.futures import ThreadPoolExecutor
 
 class Gaussian8:
     def __init__ (self):
@@ -15,6 +16,8 @@ class Gaussian8:
         self.columns = ['total_index', 'plane', 'index', 'x', 'y', 'diameter', 'intensity', 'fit_error', 'chi_square']
         self.image_clip_min = 0.0
         self.image_clip_max = numpy.iinfo(numpy.int32).max
+        self.workers = 1 # Number of threads to process planes
+        self.workspace_dtype = numpy.float32 # Filtered images (x, y, diameter and fit_error differ by ~1e-6 from float64)
 
     def output_header (self, output_file, input_filename, image_array):
         filename = os.path.basename(input_filename)
@@ -37,58 +40,96 @@ class Gaussian8:
                           (self.max_diameter, self.dup_threshold))
         output_file.write('#   image_clip_min = %f; image_clip_max = %f\n' %\
                           (self.image_clip_min, self.image_clip_max))
+        output_file.write('#   workspace_dtype = \'%s\'\n' % (numpy.dtype(self.workspace_dtype).name))
 
     def set_image_clip (self, image_array):
         self.image_clip_min = numpy.percentile(image_array, 0.1)
         self.image_clip_max = numpy.percentile(image_array, 99.9)
 
+    def gather_patches (self, float_image, xy, planes = None):
+        # gather 3x3 neighbourhood of each peak as (N, 3, 3) array (order: [y, x])
+        offsets = numpy.arange(-1, 2)
+        rows = xy[:, 0, numpy.newaxis, numpy.newaxis] + offsets[numpy.newaxis, :, numpy.newaxis]
+        cols = xy[:, 1, numpy.newaxis, numpy.newaxis] + offsets[numpy.newaxis, numpy.newaxis, :]
+
+        # peaks of many planes can be gathered at once from a stack
+        if planes is None:
+            return float_image[rows, cols]
+        else:
+            return float_image[planes[:, numpy.newaxis, numpy.newaxis], rows, cols]
+
+    def sum_patches (self, log_patches, weights):
+        # weighted sum of patches. terms are accumulated column by column (x - 1, x, x + 1)
+        # in the order of the original formulae to keep the results bitwise identical
+        result = None
+        for col in range(3):
+            for row in range(3):
+                if weights[row][col] == 0:
+                    continue
+                term = weights[row][col] * log_patches[:, row, col]
+                result = term if result is None else result + term
+
+        return result
+
+    def fit_patches (self, log_patches):
+        # log_patches: (N, 3, 3) logarithm of 3x3 patches, which can come from many planes
+        # c01 and c02 are c10 and c20 of transposed patches
+        transposed = log_patches.transpose(0, 2, 1)
+        c10 = self.sum_patches(log_patches, [[-1, 0, 1], [-1, 0, 1], [-1, 0, 1]]) / 6
+        c01 = self.sum_patches(transposed, [[-1, 0, 1], [-1, 0, 1], [-1, 0, 1]]) / 6
+        c20 = self.sum_patches(log_patches, [[1, -2, 1], [1, -2, 1], [1, -2, 1]]) / 6
+        c02 = self.sum_patches(transposed, [[1, -2, 1], [1, -2, 1], [1, -2, 1]]) / 6
+        c00 = self.sum_patches(log_patches, [[-1, 2, -1], [2, 5, 2], [-1, 2, -1]]) / 9
+
+        # fitted values at each pixel of patches
+        model_x = [c00 - c10 + c20, c00, c00 + c10 + c20]
+        model = numpy.empty(log_patches.shape, dtype = c00.dtype)
+        for col in range(3):
+            model[:, 0, col] = model_x[col] - c01 + c02
+            model[:, 1, col] = model_x[col]
+            model[:, 2, col] = model_x[col] + c01 + c02
+
+        # residuals (summed in the same order as sum_patches)
+        squares = (model - log_patches)**2
+        weighted = squares / numpy.abs(log_patches)
+        fit_error = self.sum_patches(squares, [[1, 1, 1], [1, 1, 1], [1, 1, 1]])
+        chi_square = self.sum_patches(weighted, [[1, 1, 1], [1, 1, 1], [1, 1, 1]])
+
+        return {'c00': c00, 'c10': c10, 'c01': c01, 'c20': c20, 'c02': c02, \
+                'fit_error': fit_error, 'chi_square': chi_square}
+
+    def find_duplicates (self, x, y, fit_error):
+        duplicated = numpy.zeros(len(x), dtype=bool)
+        if len(x) < 2:
+            return duplicated
+
+        # find nearest spots (the first neighbor is the spot itself).
+        # cKDTree is faster than GridIndex for spots on a plane (tens to hundreds)
+        points = numpy.array([x, y]).T
+        distances, targets = cKDTree(points).query(points, k = 2)
+        distances, targets = distances[:,1], targets[:,1]
+
+        # pairs of mutually nearest spots within dup_threshold
+        orig_indexes = numpy.arange(len(x))
+        mutual = (distances <= self.dup_threshold) & (targets[targets] == orig_indexes)
+
+        # drop the spot of larger fit_error (both are dropped if fit_errors are equal)
+        larger = fit_error > fit_error[targets]
+        duplicated[orig_indexes[mutual & larger]] = True
+        duplicated[targets[mutual & ~larger]] = True
+
+        return duplicated
+
     def gaussian_fitting (self, input_image, float_image):
         # Find local max at 1-pixel resolution (order: [y, x])
         xy = peak_local_max(float_image, min_distance = self.min_distance,\
                             threshold_abs = self.threshold_abs, exclude_border = True)
 
         # Calculate subpixel correction (x = xy[:,1], y = xy[:,0])
-        c10 = ( - numpy.log(float_image[xy[:,0] - 1, xy[:,1] - 1]) - numpy.log(float_image[xy[:,0], xy[:,1] - 1]) \
-                - numpy.log(float_image[xy[:,0] + 1, xy[:,1] - 1]) + numpy.log(float_image[xy[:,0] - 1, xy[:,1] + 1]) \
-                + numpy.log(float_image[xy[:,0], xy[:,1] + 1]) + numpy.log(float_image[xy[:,0] + 1, xy[:,1] + 1]) ) / 6
-        c01 = ( - numpy.log(float_image[xy[:,0] - 1, xy[:,1] - 1]) - numpy.log(float_image[xy[:,0] - 1, xy[:,1]]) \
-                - numpy.log(float_image[xy[:,0] - 1, xy[:,1] + 1]) + numpy.log(float_image[xy[:,0] + 1, xy[:,1] - 1]) \
-                + numpy.log(float_image[xy[:,0] + 1, xy[:,1]]) + numpy.log(float_image[xy[:,0] + 1, xy[:,1] + 1]) ) / 6
-        c20 = (   numpy.log(float_image[xy[:,0] - 1, xy[:,1] - 1]) + numpy.log(float_image[xy[:,0], xy[:,1] - 1]) \
-                + numpy.log(float_image[xy[:,0] + 1, xy[:,1] - 1]) - 2 * numpy.log(float_image[xy[:,0] - 1,xy[:,1]]) \
-                - 2 * numpy.log(float_image[xy[:,0], xy[:,1]]) - 2 * numpy.log(float_image[xy[:,0] + 1, xy[:,1]]) \
-                + numpy.log(float_image[xy[:,0] - 1, xy[:,1] + 1]) + numpy.log(float_image[xy[:,0], xy[:,1] + 1]) \
-                + numpy.log(float_image[xy[:,0] + 1, xy[:,1] + 1]) ) / 6
-        c02 = (   numpy.log(float_image[xy[:,0] - 1, xy[:,1] - 1]) + numpy.log(float_image[xy[:,0] - 1,xy[:,1]]) \
-                + numpy.log(float_image[xy[:,0] - 1, xy[:,1] + 1]) - 2 * numpy.log(float_image[xy[:,0], xy[:,1] - 1]) \
-                - 2 * numpy.log(float_image[xy[:,0], xy[:,1]]) - 2 * numpy.log(float_image[xy[:,0], xy[:,1] + 1]) \
-                + numpy.log(float_image[xy[:,0] + 1, xy[:,1] - 1]) + numpy.log(float_image[xy[:,0] + 1,xy[:,1]]) \
-                + numpy.log(float_image[xy[:,0] + 1, xy[:,1] + 1]) ) / 6
-        c00 = ( - numpy.log(float_image[xy[:,0] - 1, xy[:,1] - 1]) + 2 * numpy.log(float_image[xy[:,0], xy[:,1] - 1]) \
-                - numpy.log(float_image[xy[:,0] + 1, xy[:,1] - 1]) + 2 * numpy.log(float_image[xy[:,0] - 1,xy[:,1]]) \
-                + 5 * numpy.log(float_image[xy[:,0], xy[:,1]]) + 2 * numpy.log(float_image[xy[:,0] + 1, xy[:,1]]) \
-                - numpy.log(float_image[xy[:,0] - 1, xy[:,1] + 1]) + 2 * numpy.log(float_image[xy[:,0], xy[:,1] + 1]) \
-                - numpy.log(float_image[xy[:,0] + 1, xy[:,1] + 1]) ) / 9
-
-        fit_error = ( c00 - c10 + c20 - c01 + c02 - numpy.log(float_image[xy[:,0] - 1, xy[:,1] - 1]) )**2 \
-            + ( c00 - c10 + c20 - numpy.log(float_image[xy[:,0], xy[:,1] - 1]) )**2 \
-            + ( c00 - c10 + c20 + c01 + c02 - numpy.log(float_image[xy[:,0] + 1, xy[:,1] - 1]) )**2 \
-            + ( c00 - c01 + c02 - numpy.log(float_image[xy[:,0] - 1, xy[:,1]]) )**2 \
-            + ( c00 - numpy.log(float_image[xy[:,0], xy[:,1]]) )**2 \
-            + ( c00 + c01 + c02 - numpy.log(float_image[xy[:,0] + 1, xy[:,1]]) )**2 \
-            + ( c00 + c10 + c20 - c01 + c02 - numpy.log(float_image[xy[:,0] - 1, xy[:,1] + 1]) )**2 \
-            + ( c00 + c10 + c20 - numpy.log(float_image[xy[:,0], xy[:,1] + 1]) )**2 \
-            + ( c00 + c10 + c20 + c01 + c02 - numpy.log(float_image[xy[:,0] + 1, xy[:,1] + 1]) )**2
-
-        chi_square = ( c00 - c10 + c20 - c01 + c02 - numpy.log(float_image[xy[:,0] - 1, xy[:,1] - 1]) )**2 / numpy.abs(numpy.log(float_image[xy[:,0] - 1, xy[:,1] - 1])) \
-                   + ( c00 - c10 + c20 - numpy.log(float_image[xy[:,0], xy[:,1] - 1]) )**2 / numpy.abs(numpy.log(float_image[xy[:,0], xy[:,1] - 1])) \
-                   + ( c00 - c10 + c20 + c01 + c02 - numpy.log(float_image[xy[:,0] + 1, xy[:,1] - 1]) )**2  / numpy.abs(numpy.log(float_image[xy[:,0] + 1, xy[:,1] - 1])) \
-                   + ( c00 - c01 + c02 - numpy.log(float_image[xy[:,0] - 1, xy[:,1]]) )**2  / numpy.abs(numpy.log(float_image[xy[:,0] - 1, xy[:,1]])) \
-                   + ( c00 - numpy.log(float_image[xy[:,0], xy[:,1]]) )**2  / numpy.abs(numpy.log(float_image[xy[:,0], xy[:,1]])) \
-                   + ( c00 + c01 + c02 - numpy.log(float_image[xy[:,0] + 1, xy[:,1]]) )**2  / numpy.abs(numpy.log(float_image[xy[:,0] + 1, xy[:,1]])) \
-                   + ( c00 + c10 + c20 - c01 + c02 - numpy.log(float_image[xy[:,0] - 1, xy[:,1] + 1]) )**2  / numpy.abs(numpy.log(float_image[xy[:,0] - 1, xy[:,1] + 1])) \
-                   + ( c00 + c10 + c20 - numpy.log(float_image[xy[:,0], xy[:,1] + 1]) )**2  / numpy.abs(numpy.log(float_image[xy[:,0], xy[:,1] + 1])) \
-                   + ( c00 + c10 + c20 + c01 + c02 - numpy.log(float_image[xy[:,0] + 1, xy[:,1] + 1]) )**2  / numpy.abs(numpy.log(float_image[xy[:,0] + 1, xy[:,1] + 1]))
+        log_patches = numpy.log(self.gather_patches(float_image, xy))
+        fit_dict = self.fit_patches(log_patches)
+        c10, c01, c20, c02 = fit_dict['c10'], fit_dict['c01'], fit_dict['c20'], fit_dict['c02']
+        fit_error, chi_square = fit_dict['fit_error'], fit_dict['chi_square']
 
         x = xy[:,1] - 0.5 * (c10/c20)
         y = xy[:,0] - 0.5 * (c01/c02)
@@ -120,47 +161,32 @@ class Gaussian8:
         result_dict = {k: result_dict[k][indexes] for k in result_dict}
 
         # omit duplicated spots
-        if len(result_dict['x']) > 1:
-            indexes = numpy.ones(len(result_dict['x']), dtype=bool)
-
-            # find nearest spots
-            nn = NearestNeighbors(n_neighbors = 2, metric = 'euclidean').fit(numpy.array([result_dict['x'], result_dict['y']]).T)
-            distances, targets = nn.kneighbors(numpy.array([result_dict['x'], result_dict['y']]).T)
-            distances, targets = distances[:,1], targets[:,1]
-            pairs = numpy.zeros(len(result_dict['x']), dtype=[('orig_index', int), \
-                                                              ('near_index', int), \
-                                                              ('distance', float), \
-                                                              ('fit_error', float), \
-                                                              ('duplicated', bool)])
-            pairs['orig_index'] = numpy.arange(len(result_dict['x']))
-            pairs['near_index'] = targets
-            pairs['distance'] = distances
-            pairs['fit_error'] = result_dict['fit_error']
-            pairs['duplicated'] = False
-
-            # find duplicated points
-            for pair in pairs:
-                if (pair['distance'] <= self.dup_threshold) and (pairs[pair['near_index']]['near_index'] == pair['orig_index']):
-                    if pair['fit_error'] > pairs[pair['near_index']]['fit_error']:
-                        pairs[pair['orig_index']]['duplicated'] = True
-                    else:
-                        pairs[pair['near_index']]['duplicated'] = True
-
-            # update result_dict
-            indexes = (pairs['duplicated'] == False)
-            error_dict['duplicated'] = len(result_dict['x']) - numpy.sum(indexes)
-            result_dict = {k: result_dict[k][indexes] for k in result_dict}
-        else:
-            error_dict['duplicated'] = 0
+        indexes = ~self.find_duplicates(result_dict['x'], result_dict['y'], result_dict['fit_error'])
+        error_dict['duplicated'] = len(result_dict['x']) - numpy.sum(indexes)
+        result_dict = {k: result_dict[k][indexes] for k in result_dict}
 
         return result_dict, error_dict
 
-    def clip_array (self, float_array):
-        return float_array.clip(self.image_clip_min, self.image_clip_max)
+    def clip_array (self, float_array, output = None):
+        return float_array.clip(self.image_clip_min, self.image_clip_max, out = output)
 
-    def standardize_and_filter_image (self, float_image):
-        float_image = - (float_image - numpy.max(float_image)) / numpy.ptp(float_image)
-        return ndimage.gaussian_laplace(float_image, self.laplace)
+    def standardize_and_filter_image (self, float_image, output = None):
+        if output is None:
+            float_image = - (float_image - numpy.max(float_image)) / numpy.ptp(float_image)
+            return ndimage.gaussian_laplace(float_image, self.laplace)
+
+        # standardize float_image in place and filter into output
+        image_max, image_ptp = numpy.max(float_image), numpy.ptp(float_image)
+        numpy.subtract(float_image, image_max, out = float_image)
+        numpy.divide(float_image, - image_ptp, out = float_image)
+        return ndimage.gaussian_laplace(float_image, self.laplace, output = output)
+
+    def filter_plane (self, input_image, workspace):
+        # convert, clip and filter one plane using workspace of (2, height, width) in workspace_dtype
+        float_image, log_image = workspace[0], workspace[1]
+        float_image[:] = input_image
+        self.clip_array(float_image, output = float_image)
+        return self.standardize_and_filter_image(float_image, output = log_image)
 
     def convert_to_pandas (self, result):
         length = max([len(item) for item in result.values()])
@@ -171,9 +197,8 @@ class Gaussian8:
         numpy.seterr(divide='ignore', invalid='ignore')
 
         # get float image anf filter
-        float_image = numpy.array(input_image, 'f')
-        float_image = self.clip_array(float_image)
-        float_image = self.standardize_and_filter_image(float_image)
+        workspace = numpy.empty((2,) + input_image.shape, dtype = self.workspace_dtype)
+        float_image = self.filter_plane(input_image, workspace)
 
         # fitting
         result, error = self.gaussian_fitting(input_image, float_image)
@@ -188,29 +213,41 @@ class Gaussian8:
 
         return spot_table
 
-    def fitting_image_stack (self, input_stack):
-        numpy.seterr(divide='ignore', invalid='ignore')
+    def fitting_plane (self, input_image, index, thread_data):
+        # workspace is allocated once for each thread and reused for the following planes
+        if hasattr(thread_data, 'workspace') is False:
+            thread_data.workspace = numpy.empty((2,) + input_image.shape, dtype = self.workspace_dtype)
 
-        # get float image anf filter
-        float_stack = numpy.array(input_stack, 'f')
-        float_stack = self.clip_array(float_stack)
+        # error state of numpy is not shared with worker threads
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            # filter and fitting
+            float_image = self.filter_plane(input_image, thread_data.workspace)
+            result, error = self.gaussian_fitting(input_image, float_image)
 
-        # arrays to store results
-        result_array = []
-        error_array = []
+        # add plane and index
+        length = max([len(item) for item in result.values()])
+        result.update({'plane': numpy.full(length, index), 'index': numpy.arange(length)})
 
-        for index in range(len(input_stack)):
-            # filter and fitting
-            float_stack[index] = self.standardize_and_filter_image(float_stack[index])
-            result, error = self.gaussian_fitting(input_stack[index], float_stack[index])
+        return result, error
+
+    def fitting_image_stack (self, input_stack):
+        numpy.seterr(divide='ignore', invalid='ignore')
 
-            # add plane and index
-            length = max([len(item) for item in result.values()])
-            result.update({'plane': numpy.full(length, index), 'index': numpy.arange(length)})
+        # planes are converted, clipped and filtered one by one in workspaces
+        # of each thread instead of making a float copy of the whole stack
+        thread_data = threading.local()
 
-            # append to arrays
-            result_array.append(result)
-            error_array.append(error)
+        # filter and fitting. map() returns the results in the order of planes.
+        if self.workers > 1:
+            with ThreadPoolExecutor(max_workers = self.workers) as executor:
+                results = list(executor.map(lambda index: self.fitting_plane(input_stack[index], index, thread_data), \
+                                            range(len(input_stack))))
+        else:
+            results = [self.fitting_plane(input_stack[index], index, thread_data) for index in range(len(input_stack))]
+
+        # arrays to store results
+        result_array = [result for result, error in results]
+        error_array = [error for result, error in results]
 
         # accumulate result
         result_concat = {}
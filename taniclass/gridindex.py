@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+import sys, numpy
+
+class GridIndex:
+    def __init__ (self, points, radius):
+        # points: (N, 2) array of finite [x, y]. buckets are squares of radius.
+        self.points = numpy.asarray(points, dtype = float).reshape(-1, 2)
+        self.radius = float(radius)
+        self.cell_size = self.radius if self.radius > 0 else 1.0
+        self.table_ratio = 16 # cells of the offset table per point (binary search for larger grids)
+
+        # cell of each point (origin is moved to the minimum cell)
+        point_x, point_y = self.points[:, 0].copy(), self.points[:, 1].copy()
+        cell_x = numpy.floor(point_x / self.cell_size).astype(numpy.int64)
+        cell_y = numpy.floor(point_y / self.cell_size).astype(numpy.int64)
+        if len(self.points) > 0:
+            self.origin = numpy.array([cell_x.min(), cell_y.min()])
+            self.grid_shape = numpy.array([cell_x.max(), cell_y.max()]) - self.origin + 1
+        else:
+            self.origin = numpy.zeros(2, dtype = numpy.int64)
+            self.grid_shape = numpy.zeros(2, dtype = numpy.int64)
+
+        # sort points by cell keys. cells in a row of x are contiguous in the sorted order
+        keys = (cell_x - self.origin[0]) * self.grid_shape[1] + (cell_y - self.origin[1])
+        self.order = self.sort_order(keys)
+        self.sorted_keys = keys[self.order]
+        self.sorted_x = point_x[self.order]
+        self.sorted_y = point_y[self.order]
+
+        # offsets (CSR-style) of cells in the sorted order if the grid is not too large for the points
+        cell_count = int(numpy.prod(self.grid_shape))
+        if cell_count <= self.table_ratio * len(self.points):
+            counts = numpy.bincount(self.sorted_keys, minlength = cell_count)
+            self.cell_offsets = numpy.concatenate([[0], numpy.cumsum(counts)])
+        else:
+            self.cell_offsets = None
+
+    def sort_order (self, keys):
+        # stable order of keys. sorting unique keys (key and index) is faster than a stable sort if the keys do not overflow
+        count = len(keys)
+        if (count > 0) and (keys.max() < (2 ** 62) // count):
+            return numpy.argsort(keys * count + numpy.arange(count))
+        else:
+            return numpy.argsort(keys, kind = 'stable')
+
+    def key_offsets (self, keys, side):
+        if self.cell_offsets is not None:
+            return self.cell_offsets[keys + (1 if side == 'right' else 0)]
+        else:
+            return numpy.searchsorted(self.sorted_keys, keys, side = side)
+
+    def row_ranges (self, rows, first_columns, last_columns):
+        # ranges (positions in the sorted order) of columns first_columns to last_columns on rows
+        # (columns of a row are contiguous in the sorted order). ranges out of the grid are empty
+        if len(self.points) == 0:
+            return numpy.zeros(len(rows), dtype = int), numpy.zeros(len(rows), dtype = int)
+
+        first_columns = numpy.maximum(first_columns, 0)
+        last_columns = numpy.minimum(last_columns, self.grid_shape[1] - 1)
+        inside = (rows >= 0) & (rows < self.grid_shape[0]) & (first_columns <= last_columns)
+
+        rows = rows.clip(0, self.grid_shape[0] - 1) * self.grid_shape[1]
+        starts = self.key_offsets(rows + first_columns.clip(None, self.grid_shape[1] - 1), 'left')
+        ends = self.key_offsets(rows + last_columns.clip(0, None), 'right')
+        return starts, numpy.where(inside, ends, starts)
+
+    def expand_ranges (self, starts, ends):
+        # pairs of (range, position) for all positions in ranges
+        counts = ends - starts
+        ranges = numpy.repeat(numpy.arange(len(counts)), counts)
+        positions = numpy.arange(len(ranges)) + numpy.repeat(starts - numpy.cumsum(counts) + counts, counts)
+        return ranges, positions
+
+    def within_pairs (self, queries, positions, query_x, query_y, radii = None):
+        # omit pairs farther than radius (or radii of queries)
+        delta_x = query_x[queries] - self.sorted_x[positions]
+        delta_y = query_y[queries] - self.sorted_y[positions]
+        distances = numpy.sqrt(delta_x * delta_x + delta_y * delta_y)
+        if radii is None:
+            within = numpy.flatnonzero(distances <= self.radius)
+        else:
+            within = numpy.flatnonzero(distances <= numpy.asarray(radii)[queries])
+
+        return queries[within], self.order[positions[within]], distances[within]
+
+    def query_pairs (self, query_points, radii = None):
+        # all pairs of (query, point) within radius (or radii of queries, not larger than radius)
+        # in the order of queries. returns indexes of query points, indexes of points and distances
+        query_points = numpy.asarray(query_points, dtype = float).reshape(-1, 2)
+        query_x, query_y = query_points[:, 0].copy(), query_points[:, 1].copy()
+        query_rows = numpy.floor(query_x / self.cell_size).astype(numpy.int64) - self.origin[0]
+        query_columns = numpy.floor(query_y / self.cell_size).astype(numpy.int64) - self.origin[1]
+
+        # three neighbor rows (x-1 to x+1) of columns y-1 to y+1 for each query
+        rows = (query_rows[:, numpy.newaxis] + numpy.array([-1, 0, 1])).ravel()
+        columns = numpy.repeat(query_columns, 3)
+        starts, ends = self.row_ranges(rows, columns - 1, columns + 1)
+        ranges, positions = self.expand_ranges(starts, ends)
+
+        return self.within_pairs(ranges // 3, positions, query_x, query_y, radii)
+
+    def all_pairs (self):
+        # all pairs of points (i < j) within radius. each pair is searched once from the point
+        # earlier in the sorted order: later points of its row in columns y to y+1, and the row x+1
+        count = len(self.points)
+        rows, columns = numpy.divmod(self.sorted_keys, max(1, self.grid_shape[1]))
+        own_ends = self.row_ranges(rows, columns, columns + 1)[1]
+        next_starts, next_ends = self.row_ranges(rows + 1, columns - 1, columns + 1)
+
+        ranges, positions = self.expand_ranges(numpy.concatenate([numpy.arange(1, count + 1), next_starts]), \
+                                               numpy.concatenate([own_ends, next_ends]))
+        queries, points, distances = self.within_pairs(ranges % max(1, count), positions, self.sorted_x, self.sorted_y)
+
+        queries = self.order[queries]
+        return numpy.minimum(queries, points), numpy.maximum(queries, points), distances
+
+    def nearest (self, query_points, exclude_self = False, radii = None):
+        # nearest point within radius for each query point (the point of the smaller index for ties).
+        # returns indexes of points (-1 if not found) and distances (inf if not found)
+        query_count = len(numpy.asarray(query_points).reshape(-1, 2))
+        queries, points, distances = self.query_pairs(query_points, radii)
+        if exclude_self is True:
+            others = (queries != points)
+            queries, points, distances = queries[others], points[others], distances[others]
+
+        targets = numpy.full(query_count, -1, dtype = int)
+        target_distances = numpy.full(query_count, numpy.inf)
+        if len(queries) == 0:
+            return targets, target_distances
+
+        # minimum distance of each query (pairs are grouped by queries)
+        firsts = numpy.flatnonzero(numpy.concatenate([[True], queries[1:] != queries[:-1]]))
+        min_distances = numpy.minimum.reduceat(distances, firsts)
+        nearest = (distances == numpy.repeat(min_distances, numpy.diff(numpy.append(firsts, len(queries)))))
+
+        # smallest index of points at the minimum distance
+        candidates = numpy.where(nearest, points, len(self.points))
+        targets[queries[firsts]] = numpy.minimum.reduceat(candidates, firsts)
+        target_distances[queries[firsts]] = min_distances
+
+        return targets, target_distances
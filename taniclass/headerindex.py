@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+import os, sys, ast, json
+
+class HeaderIndex:
+    def __init__ (self):
+        self.index_filename = '.taniindex.json' # parameters of result files cached in each directory
+        self.use_index = True
+        self.indexes = {}
+        self.changed_directories = set()
+
+    def split_items (self, line):
+        # split 'key = value; key = value' at semicolons outside quotes
+        items = []
+        item = ''
+        quote = None
+        for char in line:
+            if quote is not None:
+                quote = None if char == quote else quote
+            elif char in '\'"':
+                quote = char
+            elif char == ';':
+                items.append(item)
+                item = ''
+                continue
+            item = item + char
+        items.append(item)
+        return [item.strip() for item in items if len(item.strip()) > 0]
+
+    def parse_line (self, line, params):
+        # '#   key = value; ...' (lines of '##' are titles). values are python literals,
+        # or strings if they are not literals (e.g. unquoted filenames)
+        line = line[1:].strip()
+        if (len(line) == 0) or line.startswith('#'):
+            return params
+
+        for item in self.split_items(line):
+            key, separator, value = item.partition('=')
+            key, value = key.strip(), value.strip()
+            if (separator != '=') or (key.isidentifier() is False):
+                raise Exception('invalid header line: %s' % (line))
+            try:
+                params[key] = ast.literal_eval(value)
+            except (ValueError, SyntaxError):
+                params[key] = value
+
+        return params
+
+    def read_params (self, input_filename):
+        params = {}
+        with open(input_filename, 'r') as spot_file:
+            for line in spot_file:
+                if line.startswith('#') is False:
+                    break
+                self.parse_line(line, params)
+
+        return params
+
+    def scan_file (self, input_filename, block_size = 1048576):
+        # parameters in the header and the number of spots (lines after the column names)
+        params = {}
+        with open(input_filename, 'rb') as spot_file:
+            line = spot_file.readline()
+            while line.startswith(b'#'):
+                self.parse_line(line.decode(), params)
+                line = spot_file.readline()
+
+            spot_count = 0
+            last_char = b'\n'
+            block = spot_file.read(block_size)
+            while len(block) > 0:
+                spot_count += block.count(b'\n')
+                last_char = block[-1:]
+                block = spot_file.read(block_size)
+            if last_char != b'\n':
+                spot_count += 1
+
+        return params, spot_count
+
+    def load_index (self, directory):
+        if directory not in self.indexes:
+            try:
+                with open(os.path.join(directory, self.index_filename), 'r') as index_file:
+                    self.indexes[directory] = json.load(index_file)
+            except (OSError, ValueError):
+                self.indexes[directory] = {}
+        return self.indexes[directory]
+
+    def file_entry (self, input_filename):
+        # parameters and number of spots of a file (cached while the size and time of the file are unchanged)
+        if self.use_index is False:
+            params, spot_count = self.scan_file(input_filename)
+            return {'params': params, 'spot_count': spot_count}
+
+        directory = os.path.dirname(os.path.abspath(input_filename))
+        filename = os.path.basename(input_filename)
+        index = self.load_index(directory)
+        file_stat = os.stat(input_filename)
+
+        entry = index.get(filename)
+        if (entry is None) or (entry['mtime_ns'] != file_stat.st_mtime_ns) or (entry['size'] != file_stat.st_size):
+            params, spot_count = self.scan_file(input_filename)
+            entry = {'mtime_ns': file_stat.st_mtime_ns, 'size': file_stat.st_size, \
+                     'params': params, 'spot_count': spot_count}
+            index[filename] = entry
+            self.changed_directories.add(directory)
+
+        return entry
+
+    def save (self):
+        # write changed indexes (skipped if directories are not writable)
+        for directory in sorted(self.changed_directories):
+            index_filename = os.path.join(directory, self.index_filename)
+            try:
+                with open(index_filename + '.tmp', 'w') as index_file:
+                    json.dump(self.indexes[directory], index_file, indent = 1, sort_keys = True)
+                os.replace(index_filename + '.tmp', index_filename)
+            except OSError:
+                pass
+        self.changed_directories = set()
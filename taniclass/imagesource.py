@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+import sys, threading, numpy, tifffile
+
+class ImageSource:
+    def __init__ (self, input_filenames):
+        if isinstance(input_filenames, str):
+            input_filenames = [input_filenames]
+
+        self.filenames = list(input_filenames)
+        self.lock = threading.Lock() # page decoding is not thread-safe
+        self.tiff_files = []
+        self.arrays = []
+
+        # open all files (planes are not read here)
+        plane_counts = []
+        plane_shapes = []
+        for filename in self.filenames:
+            planes, plane_shape, dtype = self.open_file(filename)
+            plane_counts.append(planes)
+            plane_shapes.append((plane_shape, numpy.dtype(dtype).name))
+
+        if len(set(plane_shapes)) > 1:
+            raise Exception('all images must have the same size and type')
+
+        # offsets of the first plane of each file in the virtual plane sequence
+        self.plane_offsets = numpy.concatenate([[0], numpy.cumsum(plane_counts)]).astype(int)
+        self.shape = (int(self.plane_offsets[-1]),) + plane_shapes[0][0]
+        self.dtype = numpy.dtype(plane_shapes[0][1])
+        self.ndim = len(self.shape)
+
+    def open_file (self, filename):
+        tiff_file = tifffile.TiffFile(filename)
+        series = tiff_file.series[0]
+        plane_shape = tuple(series.shape[-2:])
+        planes = int(numpy.prod(series.shape[:-2], dtype=int))
+        dtype = series.dtype
+
+        try:
+            # memory-map uncompressed, contiguous images
+            array = tifffile.memmap(filename, mode = 'r').reshape((planes,) + plane_shape)
+            tiff_file.close()
+            tiff_file = None
+        except ValueError:
+            if len(series.pages) == planes:
+                # decode page by page on request
+                array = None
+            else:
+                # pages do not correspond to planes (decode all at once)
+                array = series.asarray().reshape((planes,) + plane_shape)
+                tiff_file.close()
+                tiff_file = None
+
+        self.tiff_files.append(tiff_file)
+        self.arrays.append(array)
+
+        return planes, plane_shape, dtype
+
+    def close (self):
+        for tiff_file in self.tiff_files:
+            if tiff_file is not None:
+                tiff_file.close()
+
+    def __len__ (self):
+        return self.shape[0]
+
+    def __getitem__ (self, index):
+        if isinstance(index, slice):
+            return numpy.array([self.read_plane(i) for i in range(*index.indices(len(self)))], dtype = self.dtype)
+        return self.read_plane(index)
+
+    def read_plane (self, index):
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if (index < 0) or (index >= len(self)):
+            raise IndexError('plane index out of range')
+
+        file_index = numpy.searchsorted(self.plane_offsets, index, side = 'right') - 1
+        plane_index = index - self.plane_offsets[file_index]
+
+        if self.arrays[file_index] is not None:
+            return self.arrays[file_index][plane_index]
+
+        with self.lock:
+            return self.tiff_files[file_index].asarray(key = plane_index, series = 0)
+
+    def asarray (self):
+        # a single memory-mapped file is returned without copying
+        if (len(self.arrays) == 1) and (self.arrays[0] is not None):
+            return self.arrays[0]
+
+        # otherwise copy planes only once into one array
+        image_array = numpy.zeros(self.shape, dtype = self.dtype)
+        for file_index, array in enumerate(self.arrays):
+            start, end = self.plane_offsets[file_index], self.plane_offsets[file_index + 1]
+            if array is not None:
+                image_array[start:end] = array
+            else:
+                for index in range(start, end):
+                    image_array[index] = self.read_plane(index)
+
+        return image_array
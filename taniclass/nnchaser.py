@@ -1,116 +1,346 @@
 #!/usr/bin/env python
 
 import sys, numpy, pandas, time
-from sklearn.neighbors import NearestNeighbors
+import scipy.sparse as sparse
+from scipy.sparse.csgraph import connected_components, min_weight_full_bipartite_matching
+from scipy.optimize import linear_sum_assignment
+from taniclass import planeindex, gridindex, trackindex
 
 class NNChaser:
     def __init__ (self):
         self.chase_distance = 3.0
+        self.max_gap = 0 # planes that tracks can skip (missed detection)
+        self.linkers = ['nn', 'lap']
+        self.linker = self.linkers[0] # nearest neighbor or linear assignment
+        self.lap_dense_limit = 250000 # larger components are solved as sparse matrices
+
+        # motion model (kalman filter of constant velocity) to predict positions of tracks
+        self.predictors = ['none', 'kalman']
+        self.predictor = self.predictors[0]
+        self.position_noise = 0.5 # localization error (pixel)
+        self.velocity_noise = 0.5 # change of velocity in a plane (pixel/plane)
+        self.gate_factor = 3.0 # search within gate_factor * sigma of predicted positions
 
     def output_header (self, output_file):
         output_file.write('## Chased by TaniChaser at %s\n' % (time.ctime()))
         output_file.write('#   chase_distance = %f\n' % (self.chase_distance))
+        output_file.write('#   sorted_by_track = True\n')
+        output_file.write('#   linker = \'%s\'\n' % (self.linker))
+        output_file.write('#   max_gap = %d\n' % (self.max_gap))
+        output_file.write('#   predictor = \'%s\'\n' % (self.predictor))
+        if self.predictor != 'none':
+            output_file.write('#   position_noise = %f; velocity_noise = %f\n' % (self.position_noise, self.velocity_noise))
+
+    def link_spots (self, orig_xy, next_xy, gates = None):
+        # link spots on a plane (orig_xy) to spots on the next plane (next_xy) within chase_distance
+        # (or gates of orig spots). returns indexes of linked next spots (-1 if not linked) and distances
+        if self.linker == 'nn':
+            return self.link_spots_nn(orig_xy, next_xy, gates)
+        elif self.linker == 'lap':
+            return self.link_spots_lap(orig_xy, next_xy, gates)
+        else:
+            raise Exception('unknown linker: %s' % (self.linker))
+
+    def link_spots_nn (self, orig_xy, next_xy, gates = None):
+        # link to the nearest spots. conflicting links are omitted except the nearest one
+        pairs = numpy.zeros(len(orig_xy), dtype=[('orig_array_index', int), \
+                                                 ('next_array_index', int), \
+                                                 ('distance', float), \
+                                                 ('valid', bool)])
+        pairs['orig_array_index'] = numpy.arange(len(orig_xy))
+
+        if (len(orig_xy) == 0) or (len(next_xy) == 0):
+            # do not run nn since there are no spots to link
+            pairs['next_array_index'] = -1
+            return pairs['next_array_index'], pairs['distance']
+
+        # find nearest spots within chase_distance (-1 if not found)
+        targets, distances = gridindex.GridIndex(next_xy, self.chase_distance).nearest(orig_xy, radii = gates)
+
+        # make numpy array to find duplicates
+        pairs['next_array_index'] = targets
+        pairs['distance'] = distances
+        pairs['valid'] = (targets >= 0)
+
+        # find duplicated targets
+        pairs = numpy.sort(pairs, order=['next_array_index', 'distance'])
+        unique_index = numpy.unique(pairs['next_array_index'], return_index = True)[1]
+
+        # omit duplicates
+        mask = numpy.ones(len(pairs), dtype=bool)
+        mask[unique_index] = False
+        pairs['valid'][mask] = False
+
+        # delete next_index and distance
+        pairs['next_array_index'][pairs['valid'] == False] = -1
+        pairs['distance'][pairs['valid'] == False] = 0.0
+
+        # sort again
+        pairs = numpy.sort(pairs, order=['orig_array_index'])
+
+        return pairs['next_array_index'], pairs['distance']
+
+    def link_spots_lap (self, orig_xy, next_xy, gates = None):
+        # link spots by the assignment minimizing the sum of squared distances among
+        # the links of the maximum number. solved for each connected component of candidates.
+        next_indexes = numpy.full(len(orig_xy), -1, dtype=int)
+        distances = numpy.zeros(len(orig_xy), dtype=float)
+        if (len(orig_xy) == 0) or (len(next_xy) == 0):
+            return next_indexes, distances
+
+        # candidate pairs within chase_distance (sparse cost matrix)
+        origs, nexts, pair_distances = gridindex.GridIndex(next_xy, self.chase_distance).query_pairs(orig_xy, gates)
+        if len(origs) == 0:
+            return next_indexes, distances
+
+        # connected components of the bipartite graph (next spots are numbered after orig spots)
+        orig_count, next_count = len(orig_xy), len(next_xy)
+        graph = sparse.coo_matrix((numpy.ones(len(origs)), (origs, orig_count + nexts)), \
+                                  shape = (orig_count + next_count, orig_count + next_count))
+        component_count, components = connected_components(graph, directed = False)
+        orig_components, next_components = components[:orig_count], components[orig_count:]
+        labels = orig_components[origs]
+
+        # components of a single pair are linked directly
+        pair_counts = numpy.bincount(labels, minlength = component_count)
+        single = (pair_counts[labels] == 1)
+        next_indexes[origs[single]] = nexts[single]
+
+        # spots and pairs sorted by components, and local indexes of spots in each component
+        orig_order, orig_offsets, orig_locals = self.group_by_components(orig_components, component_count)
+        next_order, next_offsets, next_locals = self.group_by_components(next_components, component_count)
+        pair_order = numpy.argsort(labels, kind = 'stable')
+        origs, nexts, pair_distances = origs[pair_order], nexts[pair_order], pair_distances[pair_order]
+        pair_offsets = numpy.concatenate([[0], numpy.cumsum(pair_counts)])
+
+        # solve the assignment in other components
+        for component in numpy.flatnonzero(pair_counts > 1):
+            pair_slice = slice(pair_offsets[component], pair_offsets[component + 1])
+            orig_ids = orig_order[orig_offsets[component]:orig_offsets[component + 1]]
+            next_ids = next_order[next_offsets[component]:next_offsets[component + 1]]
+            rows, cols = self.solve_assignment(orig_locals[origs[pair_slice]], next_locals[nexts[pair_slice]], \
+                                               pair_distances[pair_slice], len(orig_ids), len(next_ids))
+            next_indexes[orig_ids[rows]] = next_ids[cols]
+
+        # distances of links
+        linked = (next_indexes >= 0)
+        delta = orig_xy[linked] - next_xy[next_indexes[linked]]
+        distances[linked] = numpy.sqrt(delta[:, 0] * delta[:, 0] + delta[:, 1] * delta[:, 1])
+
+        return next_indexes, distances
+
+    def group_by_components (self, components, component_count):
+        # order of spots sorted by components, offsets of components and indexes in components
+        order = numpy.argsort(components, kind = 'stable')
+        offsets = numpy.concatenate([[0], numpy.cumsum(numpy.bincount(components, minlength = component_count))])
+        local_indexes = numpy.zeros(len(components), dtype=int)
+        local_indexes[order] = numpy.arange(len(components)) - offsets[components[order]]
+        return order, offsets, local_indexes
+
+    def solve_assignment (self, rows, cols, pair_distances, row_count, col_count):
+        # returns linked rows and cols. pairs not in candidates cost more than any set of candidates
+        penalty = (self.chase_distance ** 2 + 1.0) * (min(row_count, col_count) + 1)
+        costs = pair_distances ** 2
+
+        if row_count * col_count <= self.lap_dense_limit:
+            cost_matrix = numpy.full((row_count, col_count), penalty)
+            cost_matrix[rows, cols] = costs
+            candidate_matrix = numpy.zeros((row_count, col_count), dtype=bool)
+            candidate_matrix[rows, cols] = True
+
+            linked_rows, linked_cols = linear_sum_assignment(cost_matrix)
+            linked = candidate_matrix[linked_rows, linked_cols]
+            return linked_rows[linked], linked_cols[linked]
+
+        # large components: sparse matrix augmented with "no link" of each spot.
+        # [[candidates, no link of rows], [no link of cols, transposed candidates]]
+        row_indexes = numpy.arange(row_count)
+        col_indexes = numpy.arange(col_count)
+        matrix_rows = numpy.concatenate([rows, row_indexes, row_count + col_indexes, row_count + cols])
+        matrix_cols = numpy.concatenate([cols, col_count + row_indexes, col_indexes, col_count + rows])
+        matrix_costs = numpy.concatenate([costs, numpy.full(row_count + col_count, penalty), numpy.zeros(len(rows))])
+
+        # costs are offset by one since zero entries are not edges (all matchings have the same size)
+        size = row_count + col_count
+        matrix = sparse.csr_matrix((matrix_costs + 1.0, (matrix_rows, matrix_cols)), shape = (size, size))
+        matched_rows, matched_cols = min_weight_full_bipartite_matching(matrix)
+        linked = (matched_rows < row_count) & (matched_cols < col_count)
+        return matched_rows[linked], matched_cols[linked]
+
+    def add_life_columns (self, spot_table):
+        # sort table by (total_index, plane)
+        track_index = trackindex.TrackIndex(spot_table)
+        spot_table = track_index.sorted_table
+
+        # add life columns from the offsets of tracks
+        spot_table['life_index'] = track_index.life_indexes()
+        spot_table['life_total'] = track_index.life_totals()
+
+        return spot_table
+
+    def empty_track_ends (self):
+        # last positions, track ids and planes of tracks with the states of the motion model
+        # (positions, velocities and the covariance matrix, which is common to x and y)
+        return numpy.zeros(0, dtype=[('x', float), ('y', float), ('total_index', int), ('plane', int), \
+                                     ('model_x', float), ('model_y', float), ('model_vx', float), ('model_vy', float), \
+                                     ('model_pp', float), ('model_pv', float), ('model_vv', float)])
+
+    def predict_track_ends (self, track_ends, plane):
+        # predicted positions, gates and covariances of track ends on a plane
+        xy = numpy.array([track_ends['x'], track_ends['y']]).T
+        if self.predictor == 'none':
+            return xy, None, None
+
+        elapsed = plane - track_ends['plane']
+        predicted_xy = numpy.array([track_ends['model_x'] + elapsed * track_ends['model_vx'], \
+                                    track_ends['model_y'] + elapsed * track_ends['model_vy']]).T
+        pp = track_ends['model_pp'] + 2 * elapsed * track_ends['model_pv'] + elapsed * elapsed * track_ends['model_vv']
+        pv = track_ends['model_pv'] + elapsed * track_ends['model_vv']
+        vv = track_ends['model_vv'] + elapsed * self.velocity_noise ** 2
+
+        # sigma of the predicted measurement
+        sigma = numpy.sqrt(pp + self.position_noise ** 2)
+        gates = numpy.minimum(self.gate_factor * sigma, self.chase_distance)
+
+        return predicted_xy, gates, (pp, pv, vv)
+
+    def update_track_ends (self, track_ends, linked, predicted_xy, covariances, xy):
+        # update the motion model of linked tracks by measured positions (xy)
+        if self.predictor == 'none':
+            return
+
+        pp, pv, vv = [covariance[linked] for covariance in covariances]
+        gain_p = pp / (pp + self.position_noise ** 2)
+        gain_v = pv / (pp + self.position_noise ** 2)
+        residuals = xy - predicted_xy[linked]
+
+        track_ends['model_x'][linked] = predicted_xy[linked, 0] + gain_p * residuals[:, 0]
+        track_ends['model_y'][linked] = predicted_xy[linked, 1] + gain_p * residuals[:, 1]
+        track_ends['model_vx'][linked] += gain_v * residuals[:, 0]
+        track_ends['model_vy'][linked] += gain_v * residuals[:, 1]
+        track_ends['model_pp'][linked] = (1 - gain_p) * pp
+        track_ends['model_pv'][linked] = (1 - gain_p) * pv
+        track_ends['model_vv'][linked] = vv - gain_v * pv
+
+    def link_track_ends (self, track_ends, plane, xy, total_indexes):
+        # link ends of active and dormant tracks (track_ends) to spots (xy) on a plane.
+        # returns total_indexes and distances of the spots, remaining track ends
+        # and total_index of finished tracks (not linked within max_gap planes).
+        total_indexes = total_indexes.copy()
+        distances = numpy.zeros(len(xy), dtype=float)
+        linked = numpy.zeros(len(track_ends), dtype=bool)
+
+        # new ends of tracks. velocities are unknown (up to chase_distance) for new tracks
+        new_ends = numpy.zeros(len(xy), dtype=track_ends.dtype)
+        new_ends['x'], new_ends['y'] = xy[:, 0], xy[:, 1]
+        new_ends['plane'] = plane
+        new_ends['model_x'], new_ends['model_y'] = xy[:, 0], xy[:, 1]
+        new_ends['model_pp'] = self.position_noise ** 2
+        new_ends['model_vv'] = self.chase_distance ** 2
+
+        if (len(track_ends) > 0) and (len(xy) > 0):
+            # link spots to the predicted positions of tracks
+            predicted_xy, gates, covariances = self.predict_track_ends(track_ends, plane)
+            next_indexes, end_distances = self.link_spots(predicted_xy, xy, gates)
+            linked = (next_indexes >= 0)
+            total_indexes[next_indexes[linked]] = track_ends['total_index'][linked]
+
+            # distances from the last positions
+            if self.predictor == 'none':
+                distances[next_indexes[linked]] = end_distances[linked]
+            else:
+                delta = xy[next_indexes[linked]] - numpy.array([track_ends['x'][linked], track_ends['y'][linked]]).T
+                distances[next_indexes[linked]] = numpy.sqrt(delta[:, 0] * delta[:, 0] + delta[:, 1] * delta[:, 1])
+
+            # linked spots take over the motion model
+            self.update_track_ends(track_ends, linked, predicted_xy, covariances, xy[next_indexes[linked]])
+            model_columns = [name for name in track_ends.dtype.names if name.startswith('model_')]
+            for name in model_columns:
+                new_ends[name][next_indexes[linked]] = track_ends[name][linked]
+
+        # spots on this plane become new ends of tracks
+        new_ends['total_index'] = total_indexes
+        track_ends = numpy.concatenate([track_ends[~linked], new_ends])
+
+        # ends that cannot be linked on the next plane
+        expired = (track_ends['plane'] + self.max_gap < plane)
+
+        return total_indexes, distances, track_ends[~expired], track_ends['total_index'][expired]
 
     def chase_spots (self, spot_table):
         numpy.set_printoptions(threshold=numpy.inf)
-        results = []
-
-        for index in range(max(spot_table.plane)):
-            # get partial spot table
-            orig_spots = spot_table[spot_table.plane == index]
-            next_spots = spot_table[spot_table.plane == index + 1]
-            if len(orig_spots) == 0:
-                results.append(numpy.array([]))
-                continue
-
-            pairs = numpy.zeros(len(orig_spots), dtype=[('orig_array_index', int), \
-                                                        ('orig_total_index', int), \
-                                                        ('next_array_index', int), \
-                                                        ('distance', float), \
-                                                        ('track_distance', float), \
-                                                        ('valid', bool)])
-
-            if len(next_spots) == 0:
-                # do not run nn since there are no spots on the next plane
-                pairs['orig_array_index'] = numpy.arange(len(orig_spots))
-                pairs['orig_total_index'] = orig_spots.total_index.values
-                pairs['next_array_index'] = -1
-                pairs['distance'] = 0.0
-                pairs['track_distance'] = 0.0
-                pairs['valid'] = False
-            else:
-                # nearest neighbor to find nearest spots
-                nn = NearestNeighbors(n_neighbors = 1, metric = 'euclidean').fit(next_spots[['x', 'y']].values)
-                distances, targets = nn.kneighbors(orig_spots[['x', 'y']].values)
-
-                # make numpy array to find duplicates and too far spots
-                pairs['orig_array_index'] = numpy.arange(len(orig_spots))
-                pairs['orig_total_index'] = orig_spots.total_index.values
-                pairs['next_array_index'] = targets.flatten()
-                pairs['distance'] = distances.flatten()
-                pairs['track_distance'] = 0.0
-                pairs['valid'] = True
-
-                # omit too far spots
-                pairs['valid'][pairs['distance'] > self.chase_distance] = False
-
-                # find duplicated targets
-                pairs = numpy.sort(pairs, order=['next_array_index', 'distance'])
-                unique_index = numpy.unique(pairs['next_array_index'], return_index = True)[1]
-
-                # omit duplicates
-                mask = numpy.ones(len(pairs), dtype=bool)
-                mask[unique_index] = False
-                pairs['valid'][mask] = False
-
-                # delete next_index and distance
-                pairs['next_array_index'][pairs['valid'] == False] = -1
-                pairs['distance'][pairs['valid'] == False] = 0.0
-
-            # sort again and save
-            pairs = numpy.sort(pairs, order=['orig_array_index'])
-            results.append(pairs)
-
-        # add last results
-        lastplane_spots = spot_table[spot_table.plane == max(spot_table.plane)]
-        pairs = numpy.zeros(len(lastplane_spots), dtype=[('orig_array_index', int), \
-                                                         ('orig_total_index', int), \
-                                                         ('next_array_index', int), \
-                                                         ('distance', float), \
-                                                         ('track_distance', float), \
-                                                         ('valid', bool)])
-        pairs['orig_array_index'] = numpy.arange(len(lastplane_spots))
-        pairs['orig_total_index'] = lastplane_spots.total_index.values
-        pairs['next_array_index'] = -1
-        pairs['distance'] = 0.0
-        pairs['track_distance'] = 0.0
-        pairs['valid'] = False
-        results.append(pairs)
-
-        # chase spots by updating total_index
-        for index in range(max(spot_table.plane)):
-            orig_pairs = results[index]
-            next_pairs = results[index + 1]
-
-            if (len(orig_pairs) == 0) or (len(next_pairs) == 0):
-                continue
-
-            orig_indexes = orig_pairs['orig_array_index'][orig_pairs['valid'] == True]
-            next_indexes = orig_pairs['next_array_index'][orig_indexes]
-            next_pairs['orig_total_index'][next_indexes] = orig_pairs['orig_total_index'][orig_indexes]
-            next_pairs['track_distance'][next_indexes] = orig_pairs['distance'][orig_indexes]
+
+        # spots of each plane are taken as slices of the table sorted by plane
+        plane_index = planeindex.PlaneIndex(spot_table)
+        total_indexes = numpy.zeros(len(spot_table), dtype=int)
+        track_distances = numpy.zeros(len(spot_table), dtype=float)
+
+        # link spots plane by plane from the ends of tracks
+        track_ends = self.empty_track_ends()
+        for index in range(max(spot_table.plane) + 1):
+            spots = plane_index.plane_spots(index)
+            positions = plane_index.plane_positions(index)
+            total_indexes[positions], track_distances[positions], track_ends, finished = \
+                    self.link_track_ends(track_ends, index, spots[['x', 'y']].values, spots.total_index.values)
 
         # update indexes and make a distance column
-        spot_table['total_index'] = numpy.concatenate([result['orig_total_index'] for result in results if len(result) > 0])
-        spot_table['distance'] = numpy.concatenate([result['track_distance'] for result in results if len(result) > 0])
+        spot_table['total_index'] = total_indexes
+        spot_table['distance'] = track_distances
 
-        # sort table
-        spot_table = spot_table.sort_values(by = ['total_index', 'plane']).reset_index(drop=True)
+        # sort table and add life columns
+        return self.add_life_columns(spot_table)
 
-        # add life column
-        spot_table['life_index'] = (spot_table.groupby('total_index').cumcount())
-        lifetime_table = spot_table['total_index'].value_counts().to_frame('life_total')
-        spot_table = pandas.merge(spot_table, lifetime_table, \
-                                    left_on='total_index', right_index=True, how='left')
+class OnlineChaser:
+    def __init__ (self, chaser = None):
+        # linking parameters are taken from NNChaser
+        self.chaser = NNChaser() if chaser is None else chaser
+        self.plane = 0
+        self.track_ends = self.chaser.empty_track_ends()
+        self.active_spots = None
 
-        return spot_table
+    def push_plane (self, spot_table):
+        # spot_table: spots on the next plane (planes must be pushed one by one, even if empty).
+        # total_index should be numbered through planes. returns spot_table with updated
+        # total_index (track id) and distance, and finished tracks with life columns.
+        spot_table = spot_table.copy()
+
+        # link from the ends of active and dormant tracks
+        total_indexes, distances, self.track_ends, finished_indexes = \
+                self.chaser.link_track_ends(self.track_ends, self.plane, spot_table[['x', 'y']].values, \
+                                            spot_table['total_index'].values)
+        spot_table['total_index'] = total_indexes
+        spot_table['distance'] = distances
+        self.plane += 1
+
+        # keep spots of active tracks only
+        if (self.active_spots is None) or (len(self.active_spots) == 0):
+            self.active_spots = spot_table
+        elif len(spot_table) > 0:
+            self.active_spots = pandas.concat([self.active_spots, spot_table], ignore_index = True)
+
+        # tracks not linked within max_gap planes are finished
+        finished_table = None
+        if len(finished_indexes) > 0:
+            finished = self.active_spots['total_index'].isin(finished_indexes)
+            finished_table = self.chaser.add_life_columns(self.active_spots[finished])
+            self.active_spots = self.active_spots[~finished]
+
+        return spot_table, finished_table
+
+    def first_active_index (self):
+        # the smallest total_index of active tracks (inf if none)
+        if len(self.track_ends) == 0:
+            return numpy.inf
+        return self.track_ends['total_index'].min()
+
+    def finish (self):
+        # finish all active tracks
+        finished_table = None
+        if (self.active_spots is not None) and (len(self.active_spots) > 0):
+            finished_table = self.chaser.add_life_columns(self.active_spots)
+
+        self.plane = 0
+        self.track_ends = self.chaser.empty_track_ends()
+        self.active_spots = None
+
+        return finished_table
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+import sys, numpy
+
+class PlaneIndex:
+    def __init__ (self, spot_table, total_planes = 0):
+        self.spot_table = spot_table
+        self.sorted_table = None
+        self.order = None
+
+        # number of spots in each plane and offsets (CSR-style) of planes in the sorted table
+        planes = spot_table['plane'].values.astype(int)
+        self.plane_counts = numpy.bincount(planes, minlength = total_planes)
+        self.plane_offsets = numpy.concatenate([[0], numpy.cumsum(self.plane_counts)]).astype(int)
+
+    def sort_table (self):
+        # sort by plane only once (stable sort keeps the order of spots in each plane)
+        if self.sorted_table is not None:
+            return
+
+        planes = self.spot_table['plane'].values
+        if numpy.all(planes[:-1] <= planes[1:]):
+            self.order = numpy.arange(len(planes))
+            self.sorted_table = self.spot_table
+        else:
+            self.order = numpy.argsort(planes, kind = 'stable')
+            self.sorted_table = self.spot_table.iloc[self.order]
+
+    def plane_range (self, plane):
+        if (plane < 0) or (plane >= len(self.plane_counts)):
+            return 0, 0
+        return self.plane_offsets[plane], self.plane_offsets[plane + 1]
+
+    def plane_spots (self, plane):
+        # spots in a plane as a slice of the sorted table
+        self.sort_table()
+        start, end = self.plane_range(plane)
+        return self.sorted_table.iloc[start:end]
+
+    def chunk_spots (self, start_plane, end_plane):
+        # spots in planes from start_plane to end_plane - 1 as a slice of the sorted table
+        self.sort_table()
+        start = self.plane_offsets[min(max(start_plane, 0), len(self.plane_counts))]
+        end = self.plane_offsets[min(max(end_plane, 0), len(self.plane_counts))]
+        return self.sorted_table.iloc[start:end]
+
+    def plane_positions (self, plane):
+        # row positions of spots in a plane in the original table
+        self.sort_table()
+        start, end = self.plane_range(plane)
+        return self.order[start:end]
@@ -1,19 +1,21 @@
 #!/usr/bin/env python
 
-import sys, time, numpy, tifffile
+import sys, time, numpy, pandas, tifffile
+from taniclass import trackindex
 
 class SpotFilter:
     def __init__ (self):
         self.lifetime_min = 0
         self.lifetime_max = numpy.inf
         self.mask_image_filename = None
+        self.mask_image = None
 
     def output_header (self, output_file):
         output_file.write('## Filtered by SpotFilter at %s\n' % (time.ctime()))
         output_file.write('#   mask_image = %s\n' % (self.mask_image_filename))
 
-    def filter_spots_lifetime (self, spot_table):
-        spot_table = spot_table.sort_values(by = ['total_index', 'plane']).reset_index(drop=True)
+    def filter_spots_lifetime (self, spot_table, is_sorted = None):
+        spot_table = trackindex.TrackIndex(spot_table, is_sorted).sorted_table
         spot_table = spot_table[(self.lifetime_min <= spot_table.life_total) & \
                                 (spot_table.life_total <= self.lifetime_max)].reset_index(drop=True)
 
@@ -33,21 +35,35 @@ class SpotFilter:
         spot_table = spot_table.drop_duplicates(subset='total_index', keep='last').reset_index(drop=True)
         return spot_table
 
-    def average_spots (self, spot_table):
-        agg_dict = {x : numpy.max for x in spot_table.columns}
-        agg_dict['x'] = numpy.mean
-        agg_dict['y'] = numpy.mean
-        agg_dict['intensity'] = numpy.mean
-        agg_dict['distance'] = numpy.sum
-        spot_table = spot_table.groupby('total_index').agg(agg_dict).reset_index(drop=True)
-        return spot_table
+    def average_spots (self, spot_table, is_sorted = None):
+        if len(spot_table) == 0:
+            return spot_table.reset_index(drop=True)
+
+        # reduce spots in each track (mean for x, y and intensity, sum for distance, max for others)
+        track_index = trackindex.TrackIndex(spot_table, is_sorted)
+        firsts = track_index.first_positions()
+
+        reduced_columns = {}
+        for column in spot_table.columns:
+            values = track_index.sorted_table[column].values
+            if column in ['x', 'y', 'intensity']:
+                reduced_columns[column] = numpy.add.reduceat(values.astype(float), firsts) / track_index.track_counts
+            elif column == 'distance':
+                reduced_columns[column] = numpy.add.reduceat(values, firsts)
+            else:
+                reduced_columns[column] = numpy.maximum.reduceat(values, firsts)
+
+        return pandas.DataFrame(reduced_columns, columns = spot_table.columns)
 
     def filter_spots_maskimage (self, spot_table):
         if self.mask_image_filename is None:
             return spot_table
 
-        mask_image = tifffile.imread(self.mask_image_filename)
-        mask_image = mask_image.astype(bool).astype(numpy.uint8)
+        # read mask image only once (tables can be filtered chunk by chunk)
+        if self.mask_image is None:
+            self.mask_image = tifffile.imread(self.mask_image_filename)
+            self.mask_image = self.mask_image.astype(bool).astype(numpy.uint8)
+        mask_image = self.mask_image
 
         first_spot_table = spot_table.drop_duplicates(subset='total_index', keep='first').reset_index(drop=True)
         first_spot_table['mask'] = mask_image[first_spot_table.y.values.astype(int), first_spot_table.x.values.astype(int)]
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 
-import sys, numpy
-from PIL import Image, ImageDraw
+import sys, numpy, tifffile
+from PIL import Image, ImageDraw, ImageColor
+from taniclass import planeindex
 
 class SpotMarker:
     def __init__ (self):
@@ -14,8 +15,35 @@ class SpotMarker:
         self.marker_rainbow = False
         self.rainbow_colors = numpy.array(["red", "blue", "green", "magenta", "purple", "cyan",\
                                            "orange", "maroon"])
+        self.chunk_planes = 64 # planes colored and marked at once when writing movies
+
+    def display_range (self, image_source):
+        # range of 8-bit conversion (mean - 3 sigma to mean + 4 sigma) from running sums of planes.
+        # None for 8-bit images (used as is)
+        image_type = numpy.dtype(image_source.dtype).name
+        if image_type == 'uint8':
+            return None
+        elif image_type != 'int32' and image_type != 'uint16':
+            raise Exception('invalid image file format')
+
+        pixel_count = 0
+        pixel_sum = 0.0
+        square_sum = 0.0
+        for index in range(len(image_source)):
+            plane = numpy.asarray(image_source[index], dtype = numpy.float64).ravel()
+            pixel_count += len(plane)
+            pixel_sum += numpy.sum(plane)
+            square_sum += numpy.dot(plane, plane)
+
+        mean = pixel_sum / pixel_count
+        sigma = numpy.sqrt(max(square_sum / pixel_count - mean * mean, 0.0))
+        image_min = max(0, mean - 3 * sigma)
+        image_max = min(mean + 4 * sigma, numpy.iinfo(image_source.dtype).max)
 
-    def convert_to_color (self, orig_image):
+        return image_min, image_max
+
+    def convert_to_color (self, orig_image, display_range = None):
+        # display_range: (min, max) used for 16/32-bit images (calculated from orig_image if None)
         if (len(orig_image.shape) > 3):
             print("Image with dimension > 3 was passed to conversion to color. Might be colored image. Conversion ignored.")
             return orig_image
@@ -24,10 +52,13 @@ class SpotMarker:
 
         image_type = orig_image.dtype.name
         if image_type == 'int32' or image_type == 'uint16':
-            mean = numpy.mean(orig_image)
-            sigma = numpy.std(orig_image)
-            image_min = max(0, mean - 3 * sigma)
-            image_max = min(mean + 4 * sigma, numpy.iinfo(orig_image.dtype).max)
+            if display_range is None:
+                mean = numpy.mean(orig_image)
+                sigma = numpy.std(orig_image)
+                image_min = max(0, mean - 3 * sigma)
+                image_max = min(mean + 4 * sigma, numpy.iinfo(orig_image.dtype).max)
+            else:
+                image_min, image_max = display_range
             image_8bit = (255.0 * (orig_image - image_min) / (image_max - image_min)).clip(0, 255).astype(numpy.uint8)
             image_color[:,:,:,0] = image_color[:,:,:,1] = image_color[:,:,:,2] = image_8bit
         elif image_type == 'uint8':
@@ -41,27 +72,75 @@ class SpotMarker:
         return image_color
 
     def tracking_status (self, spot_table):
-        total_indexes = spot_table.total_index.tolist()
-
-        status = ['cont' for i in range(len(total_indexes))]
-        status[0] = 'new'
-
-        for i in range(len(status) - 1):
-            if total_indexes[i] < total_indexes[i + 1]:
-                #print(total_indexes[i], total_indexes[i+1])
-                if status[i] == 'new':
-                    status[i], status[i + 1] = 'one', 'new'
-                else:
-                    status[i], status[i + 1] = 'end', 'new'
-        if status[-1] == 'new':
-            status[-1] = 'one'
-        else:
-            status[-1] = 'end'
-
-        return status
-
-    def mark_spots (self, image_color, spot_table):
-        # copy for working
+        # status of spots in a table sorted by tracks (new, cont, end, or one for tracks of a spot)
+        total_indexes = spot_table.total_index.values
+        if len(total_indexes) == 0:
+            return numpy.zeros(0, dtype=object)
+
+        boundaries = (total_indexes[:-1] != total_indexes[1:])
+        firsts = numpy.concatenate([[True], boundaries])
+        lasts = numpy.concatenate([boundaries, [True]])
+
+        # cont (0), new (1), end (2) or one (3)
+        status_names = numpy.array(['cont', 'new', 'end', 'one'], dtype=object)
+        return status_names[firsts.astype(int) + 2 * lasts.astype(int)]
+
+    def marker_stamps (self):
+        # pixels drawn by PIL for ellipse, arc, rectangle and shifted ellipse (duplicated) markers,
+        # as offsets from spots. returns offsets of all stamps and their ranges (CSR-style)
+        size = self.marker_size
+        center = 2 * size + self.marker_width + 4
+        box = ((center - size, center - size), (center + size, center + size))
+        shifted_box = ((center - size + 1, center - size + 1), (center + size + 1, center + size + 1))
+
+        offsets_y, offsets_x = [], []
+        for kind in range(4):
+            image = Image.new('L', (2 * center + 1, 2 * center + 1), 0)
+            draw = ImageDraw.Draw(image)
+            if kind == 0:
+                draw.ellipse(box, fill = None, width = self.marker_width, outline = 255)
+            elif kind == 1:
+                draw.arc(box, 315, 135, width = self.marker_width, fill = 255)
+            elif kind == 2:
+                draw.rectangle(box, fill = None, width = self.marker_width, outline = 255)
+            else:
+                draw.ellipse(shifted_box, fill = None, width = self.marker_width, outline = 255)
+
+            stamp_y, stamp_x = numpy.nonzero(numpy.asarray(image))
+            offsets_y.append(stamp_y - center)
+            offsets_x.append(stamp_x - center)
+
+        stamp_offsets = numpy.concatenate([[0], numpy.cumsum([len(offset) for offset in offsets_y])])
+        return numpy.concatenate(offsets_y), numpy.concatenate(offsets_x), stamp_offsets
+
+    def draw_markers (self, image_color, planes, int_x, int_y, marker_kinds, color_names, chunk_size = 1000000):
+        # draw markers (kinds of stamps) at once. later markers overwrite earlier ones
+        offsets_y, offsets_x, stamp_offsets = self.marker_stamps()
+        stamp_sizes = numpy.diff(stamp_offsets)
+
+        # colors as RGB values
+        unique_names, name_indexes = numpy.unique(color_names.astype(str), return_inverse = True)
+        rgb_colors = numpy.array([ImageColor.getrgb(name)[0:3] for name in unique_names], dtype=numpy.uint8).reshape(-1, 3)
+
+        planes_count, height, width = image_color.shape[0:3]
+        for start in range(0, len(planes), chunk_size):
+            chunk = slice(start, start + chunk_size)
+
+            # expand markers into pixels of stamps
+            counts = stamp_sizes[marker_kinds[chunk]]
+            markers = numpy.repeat(numpy.arange(len(counts)), counts) + start
+            positions = numpy.repeat(stamp_offsets[marker_kinds[chunk]] - numpy.cumsum(counts) + counts, counts) + \
+                        numpy.arange(numpy.sum(counts))
+            pixel_y = int_y[markers] + offsets_y[positions]
+            pixel_x = int_x[markers] + offsets_x[positions]
+
+            # pixels in images
+            inside = (0 <= pixel_y) & (pixel_y < height) & (0 <= pixel_x) & (pixel_x < width) & \
+                     (0 <= planes[markers]) & (planes[markers] < planes_count)
+            image_color[planes[markers[inside]], pixel_y[inside], pixel_x[inside]] = rgb_colors[name_indexes[markers[inside]]]
+
+    def marker_table (self, spot_table):
+        # status and colors of spots (tracks are judged in the whole table)
         work_table = spot_table.copy()
 
         # set colors
@@ -98,54 +177,73 @@ class SpotMarker:
             else:
                 work_table = work_table[work_table.total_index.isin(index_set)].reset_index(drop=True)                
 
-        # draw markers
-        skipped_planes = []
-        for index in range(len(image_color)):
-            spots = work_table[work_table.plane == index].reset_index(drop=True)
-
-            if len(spots) == 0:
-                skipped_planes.append(index)
-                continue
-
-            spots['int_x'] = spots['x'].astype(int)
-            spots['int_y'] = spots['y'].astype(int)
-            spots = spots.sort_values(by = ['int_x', 'int_y']).reset_index(drop=True)
-
-            # check possible error spots (duplicated)
-            spots['duplicated'] = spots.duplicated(subset = ['int_x', 'int_y'], keep = False)
-            error_spots = len(spots[spots['duplicated'] == True])
-            if error_spots > 0:
-                print("Possible %d duplicated spots in plane %d." % (error_spots, index))
-
-            image = Image.fromarray(image_color[index])
-            draw = ImageDraw.Draw(image)
-
-            for row, spot in spots.iterrows():
-                # draw marker
-                if spot['status'] == 'emerge':
-                    draw.rectangle(((spot.int_x - self.marker_size, spot.int_y - self.marker_size),\
-                                   (spot.int_x + self.marker_size, spot.int_y + self.marker_size)),\
-                                   fill = None, width = self.marker_width, outline = spot.color)
-                else:
-                    draw.ellipse(((spot.int_x - self.marker_size, spot.int_y - self.marker_size),\
-                                (spot.int_x + self.marker_size, spot.int_y + self.marker_size)),\
-                                fill = None, width = self.marker_width, outline = spot.color)
-
-                    # draw additional marker
-                    if spot['status'] == 'one':
-                        draw.arc(((spot.int_x - self.marker_size, spot.int_y - self.marker_size),\
-                                (spot.int_x + self.marker_size, spot.int_y + self.marker_size)),\
-                                315, 135, width = self.marker_width, fill = marker_color_end)
-
-                # mark duplicated spot
-                if spot['duplicated'] is True:
-                    draw.ellipse(((spot.int_x - self.marker_size + 1, spot.int_y - self.marker_size + 1),\
-                                  (spot.int_x + self.marker_size + 1, spot.int_y + self.marker_size + 1)),\
-                                  fill = None, width = self.marker_width, outline = self.marker_colors[3])
-
-            image_color[index] = numpy.asarray(image)
-
+        return work_table
+
+    def draw_spots (self, image_color, work_table, first_plane = 0):
+        # draw spots of a marker table on planes from first_plane (image_color[0])
+        # spots in the order of drawing (sorted by planes and pixels)
+        planes = work_table['plane'].values.astype(int) - first_plane
+        int_x = work_table['x'].values.astype(int)
+        int_y = work_table['y'].values.astype(int)
+        order = numpy.lexsort((int_y, int_x, planes))
+        planes, int_x, int_y = planes[order], int_x[order], int_y[order]
+        status = work_table['status'].values[order]
+        colors = work_table['color'].values[order]
+
+        # check possible error spots (duplicated)
+        same_pixel = (planes[1:] == planes[:-1]) & (int_x[1:] == int_x[:-1]) & (int_y[1:] == int_y[:-1])
+        duplicated = numpy.zeros(len(planes), dtype=bool)
+        duplicated[1:] |= same_pixel
+        duplicated[:-1] |= same_pixel
+        error_counts = numpy.bincount(planes[duplicated], minlength = len(image_color))
+        for index in numpy.flatnonzero(error_counts[:len(image_color)]):
+            print("Possible %d duplicated spots in plane %d." % (error_counts[index], index + first_plane))
+
+        # markers of each spot: ellipse (rectangle if emerge), arc if one, and shifted ellipse if duplicated
+        emerge = (status == 'emerge')
+        marker_kinds = numpy.array([numpy.where(emerge, 2, 0), numpy.full(len(status), 1), numpy.full(len(status), 3)]).T
+        marker_drawn = numpy.array([numpy.ones(len(status), dtype=bool), (status == 'one') & ~emerge, duplicated]).T
+        color_names = numpy.array([colors, numpy.full(len(status), self.marker_colors[2], dtype=object), \
+                                   numpy.full(len(status), self.marker_colors[3], dtype=object)]).T
+
+        # draw markers in the order of spots (later markers overwrite earlier ones)
+        marker_drawn = marker_drawn.ravel()
+        self.draw_markers(image_color, numpy.repeat(planes, 3)[marker_drawn], numpy.repeat(int_x, 3)[marker_drawn], \
+                          numpy.repeat(int_y, 3)[marker_drawn], marker_kinds.ravel()[marker_drawn], \
+                          color_names.ravel()[marker_drawn])
+
+    def print_skipped_planes (self, work_table, total_planes):
+        planes = work_table['plane'].values.astype(int)
+        skipped_planes = numpy.flatnonzero(numpy.bincount(planes[planes < total_planes], minlength = total_planes) == 0).tolist()
         if sum(skipped_planes) > 0:
             print("Skipped planes %s." % (' '.join(map(str, skipped_planes))))
 
+    def mark_spots (self, image_color, spot_table):
+        work_table = self.marker_table(spot_table)
+        self.draw_spots(image_color, work_table)
+        self.print_skipped_planes(work_table, len(image_color))
+
         return image_color
+
+    def write_marked_movie (self, output_filename, image_source, spot_table):
+        # color, mark and append planes to a multipage tiff chunk by chunk (memory is bounded by chunk_planes)
+        total_planes = len(image_source)
+        display_range = self.display_range(image_source)
+        work_table = self.marker_table(spot_table)
+        plane_index = planeindex.PlaneIndex(work_table, total_planes)
+
+        def marked_planes ():
+            for start in range(0, total_planes, self.chunk_planes):
+                end = min(start + self.chunk_planes, total_planes)
+                image_color = self.convert_to_color(image_source[start:end], display_range)
+                self.draw_spots(image_color, plane_index.chunk_spots(start, end), start)
+                for plane in image_color:
+                    yield plane
+
+        # bigtiff if the file may exceed 4 GB
+        shape = (total_planes,) + tuple(image_source.shape[1:3]) + (3,)
+        bigtiff = (int(numpy.prod(shape, dtype = numpy.int64)) > 2 ** 32 - 2 ** 25)
+        tifffile.imwrite(output_filename, marked_planes(), shape = shape, dtype = numpy.uint8, \
+                         photometric = 'rgb', bigtiff = bigtiff)
+
+        self.print_skipped_planes(work_table, total_planes)
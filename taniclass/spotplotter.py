@@ -1,56 +1,186 @@
 #!/usr/bin/env python
 
-import sys, numpy, pandas
+import sys, itertools, numpy, tifffile
+from scipy.special import erf
+from taniclass import tileimage, driftmodel, headerindex
 
 class SpotPlotter:
     def __init__ (self):
         self.image_scale = 4
         self.align_each = 500
+        self.drift_models = ['step', 'linear', 'spline']
+        self.drift_model = 'step'
+        self.tile_size = 0 # accumulate in tiles allocated when touched (0 for a dense image)
+        self.plot_modes = ['point', 'bilinear', 'gaussian']
+        self.plot_mode = 'point'
+        self.splat_sigma = 0.25 # sigma of gaussian splats (pixel of the original image)
+        self.splat_column = None # column of sigma for each spot (splat_sigma is used if None)
+        self.splat_subpixels = 8 # subpixel offsets of splat kernels in a pixel
+        self.kernel_luts = {}
+        self.header_index = headerindex.HeaderIndex()
 
     def read_image_size (self, input_filename):
         params = self.read_image_params(input_filename)
         return int(params['width']), int(params['height'])
 
     def read_image_params (self, input_filename):
-        params = {}
-        with open(input_filename, 'r') as spot_file:
-            for line in spot_file:
-                if line.startswith('#') is False:
-                    break
-                line = line[1:].strip()
-                exec(line, {}, params)
-
-        return params
-
-    def plot_spots (self, last_image, last_plane, spot_table, align_table):
-        # prepare working array
-        work_image = last_image.copy()
-
-        # make spots dataframe
-        spots = spot_table[['plane', 'x', 'y']].copy().reset_index(drop=True)
-
-        # scale and alignment
-        if align_table is not None:
-            spots['align_index'] = ((spots['plane'] + last_plane) // self.align_each)
-            spots = pandas.merge(spots, align_table, left_on='align_index', right_on='align_plane', how='left')
-            spots['plot_x'] = ((spots['x']  - spots['align_x']) * self.image_scale).astype(int)
-            spots['plot_y'] = ((spots['y']  - spots['align_y']) * self.image_scale).astype(int)
+        # parameters in the header (parsed, not executed)
+        return self.header_index.read_params(input_filename)
+
+    def init_image (self, width, height):
+        # accumulator of plotted spots (owned by the plotter and updated in place).
+        # splats are accumulated as float weights
+        dtype = numpy.int64 if self.plot_mode == 'point' else numpy.float64
+        if self.tile_size > 0:
+            self.plot_image = tileimage.TileImage((height * self.image_scale, width * self.image_scale), self.tile_size, dtype)
+        else:
+            self.plot_image = numpy.zeros((height * self.image_scale, width * self.image_scale), dtype=dtype)
+        return self.plot_image
+
+    def clear_image (self):
+        self.plot_image.fill(0)
+
+    def fit_drift (self, align_table):
+        # drift model fitted once to an alignment table (None if not aligned)
+        if align_table is None:
+            return None
+        return driftmodel.DriftModel(align_table, self.align_each, self.drift_model)
+
+    def plot_spots (self, last_plane, spot_table, drift):
+        # scale and alignment (drift is evaluated at the plane of each spot)
+        if drift is not None:
+            offset_x, offset_y = drift.offsets(spot_table['plane'].values + last_plane)
+            scaled_x = (spot_table['x'].values - offset_x) * self.image_scale
+            scaled_y = (spot_table['y'].values - offset_y) * self.image_scale
+        else:
+            scaled_x = spot_table['x'].values * self.image_scale
+            scaled_y = spot_table['y'].values * self.image_scale
+        valid = numpy.isfinite(scaled_x) & numpy.isfinite(scaled_y)
+
+        if self.plot_mode == 'point':
+            self.plot_points(scaled_y[valid].astype(int), scaled_x[valid].astype(int))
+        elif self.plot_mode in ['bilinear', 'gaussian']:
+            # sigma of each spot in pixels of the plot (quantized to share kernels)
+            if self.plot_mode == 'bilinear':
+                sigmas = numpy.zeros(len(spot_table))
+            elif self.splat_column is None:
+                sigmas = numpy.full(len(spot_table), self.splat_sigma * self.image_scale)
+            elif self.splat_column in spot_table.columns:
+                sigmas = spot_table[self.splat_column].values * self.image_scale
+            else:
+                raise Exception('column %s for sigma of splats does not exist' % (self.splat_column))
+            sigmas = numpy.maximum(numpy.round(numpy.nan_to_num(sigmas) * 4) / 4, 0.25)
+
+            for sigma in numpy.unique(sigmas):
+                group = (sigmas == sigma) & valid
+                self.splat_spots(scaled_y[group], scaled_x[group], sigma)
         else:
-            spots['plot_x'] = (spots['x'] * self.image_scale).astype(int)
-            spots['plot_y'] = (spots['y'] * self.image_scale).astype(int)
+            raise Exception('unknown plot mode')
+
+        return self.plot_image
 
+    def plot_points (self, plot_y, plot_x):
         # drop inappropriate spots
-        height, width = work_image.shape
-        spots = spots[(0 <= spots['plot_x']) & (spots['plot_x'] < width) & \
-                      (0 <= spots['plot_y']) & (spots['plot_y'] < height)].reset_index(drop=True)
+        height, width = self.plot_image.shape
+        inside = (0 <= plot_x) & (plot_x < width) & (0 <= plot_y) & (plot_y < height)
 
         # plot spots
-        work_array = numpy.zeros(work_image.shape, dtype=numpy.int32)
-        plot_x = spots.plot_x.values
-        plot_y = spots.plot_y.values
-        numpy.add.at(work_array, (plot_y, plot_x), 1)
+        if self.tile_size > 0:
+            self.plot_image.add_pixels(plot_y[inside], plot_x[inside])
+        else:
+            self.accumulate_pixels(plot_y[inside] * width + plot_x[inside])
+
+    def kernel_lut (self, sigma):
+        # 1D kernels for subpixel offsets of spots (offsets x kernel pixels from -radius to radius).
+        # gaussian kernels are integrated over pixels. kernels are normalized to 1
+        key = (self.plot_mode, sigma, self.splat_subpixels)
+        if key in self.kernel_luts:
+            return self.kernel_luts[key]
 
-        # combine with work_image
-        work_image = work_image + work_array
+        offsets = (numpy.arange(self.splat_subpixels) + 0.5) / self.splat_subpixels
+        if self.plot_mode == 'bilinear':
+            radius = 1
+            centers = numpy.arange(-radius, radius + 1) + 0.5
+            kernels = numpy.clip(1.0 - numpy.abs(centers[numpy.newaxis, :] - offsets[:, numpy.newaxis]), 0, None)
+        else:
+            radius = int(numpy.ceil(3.0 * sigma))
+            edges = numpy.arange(-radius, radius + 2)
+            kernels = numpy.diff(erf((edges[numpy.newaxis, :] - offsets[:, numpy.newaxis]) / (numpy.sqrt(2.0) * sigma)), axis = 1)
+        kernels = kernels / kernels.sum(axis = 1, keepdims = True)
 
-        return work_image
+        self.kernel_luts[key] = (radius, kernels)
+        return radius, kernels
+
+    def splat_spots (self, scaled_y, scaled_x, sigma, chunk_size = 1000000):
+        # add kernels of the nearest subpixel offsets around spots (chunk_size limits pixels at once)
+        radius, kernels = self.kernel_lut(sigma)
+        kernel_size = 2 * radius + 1
+        kernel_pixels = numpy.arange(-radius, radius + 1)
+        height, width = self.plot_image.shape
+
+        floor_y, floor_x = numpy.floor(scaled_y), numpy.floor(scaled_x)
+        offsets_y = numpy.clip(((scaled_y - floor_y) * self.splat_subpixels).astype(int), 0, self.splat_subpixels - 1)
+        offsets_x = numpy.clip(((scaled_x - floor_x) * self.splat_subpixels).astype(int), 0, self.splat_subpixels - 1)
+        floor_y, floor_x = floor_y.astype(int), floor_x.astype(int)
+
+        chunk_spots = max(1, chunk_size // (kernel_size * kernel_size))
+        for start in range(0, len(scaled_y), chunk_spots):
+            chunk = slice(start, start + chunk_spots)
+            pixel_y = floor_y[chunk, numpy.newaxis, numpy.newaxis] + kernel_pixels[numpy.newaxis, :, numpy.newaxis]
+            pixel_x = floor_x[chunk, numpy.newaxis, numpy.newaxis] + kernel_pixels[numpy.newaxis, numpy.newaxis, :]
+            weights = kernels[offsets_y[chunk]][:, :, numpy.newaxis] * kernels[offsets_x[chunk]][:, numpy.newaxis, :]
+            pixel_y, pixel_x = numpy.broadcast_arrays(pixel_y, pixel_x)
+
+            inside = (0 <= pixel_x) & (pixel_x < width) & (0 <= pixel_y) & (pixel_y < height)
+            if self.tile_size > 0:
+                self.plot_image.add_pixels(pixel_y[inside], pixel_x[inside], weights[inside])
+            else:
+                self.accumulate_pixels(pixel_y[inside] * width + pixel_x[inside], weights[inside])
+
+    def accumulate_pixels (self, pixel_indexes, weights = None):
+        # add counts (or weights) of flattened pixel indexes into the accumulator in place
+        if len(pixel_indexes) == 0:
+            return
+
+        flat_image = self.plot_image.reshape(-1)
+        first_pixel, last_pixel = pixel_indexes.min(), pixel_indexes.max()
+        if (last_pixel - first_pixel) < 64 * len(pixel_indexes):
+            # histogram over the range of pixels
+            flat_image[first_pixel:last_pixel + 1] += numpy.bincount(pixel_indexes - first_pixel, weights = weights)
+        else:
+            # few spots scattered in a large image
+            pixels, inverse = numpy.unique(pixel_indexes, return_inverse = True)
+            flat_image[pixels] += numpy.bincount(inverse, weights = weights).astype(flat_image.dtype)
+
+    def write_images (self, output_filename, images, description = None, image_count = None):
+        # output accumulators (an image, a list of images or an iterator of image_count images)
+        # clipped to 32bit (float32 for splats). images of an iterator are written when they are made
+        if image_count is None:
+            images = images if isinstance(images, list) else [images]
+            image_count = len(images)
+        images = iter(images)
+        first_image = next(images)
+        images = itertools.chain([first_image], images)
+
+        shape = tuple(first_image.shape) if image_count == 1 else (image_count,) + tuple(first_image.shape)
+        dtype = numpy.float32 if first_image.dtype.kind == 'f' else numpy.int32
+        max_value = None if first_image.dtype.kind == 'f' else numpy.iinfo(numpy.int32).max
+
+        if self.tile_size > 0:
+            # tiled BigTIFF (tiles that were not touched are compressed)
+            def clipped_tiles ():
+                for image in images:
+                    for tile in image.clipped_tiles(dtype):
+                        yield tile
+            tifffile.imwrite(output_filename, clipped_tiles(), shape = shape, dtype = dtype, \
+                             tile = (self.tile_size, self.tile_size), bigtiff = True, compression = 'zlib', \
+                             description = description)
+        elif image_count == 1:
+            tifffile.imwrite(output_filename, first_image.clip(0, max_value).astype(dtype), description = description)
+        else:
+            # clip plane by plane
+            def clipped_planes ():
+                for image in images:
+                    yield image.clip(0, max_value).astype(dtype)
+            tifffile.imwrite(output_filename, clipped_planes(), shape = shape, dtype = dtype, \
+                             description = description)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+import sys, copy, multiprocessing, numpy, pandas
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+class SpotRender:
+    def __init__ (self, plotter, chaser, filter):
+        self.plotter = plotter
+        self.chaser = chaser
+        self.filter = filter
+        self.workers = 1 # number of processes to render files in parallel
+        self.drift = None # drift model fitted to the alignment table
+        self.chase_spots = False
+        self.lifetime_range = [1, 0]
+        self.consolidate_spots = False
+        self.consolidate_mode = 'first'
+        self.omit_lastplane_spots = False
+        self.stack_modes = ['separate', 'cumulative']
+
+    def read_file_params (self, input_filenames):
+        # parameters of each file and the first plane of each file in the sequence of all files
+        # (read from the index of directories without opening unchanged files)
+        header_index = self.plotter.header_index
+        entries = [header_index.file_entry(input_filename) for input_filename in input_filenames]
+        header_index.save()
+
+        file_params = [entry['params'] for entry in entries]
+        plane_offsets = numpy.concatenate([[0], numpy.cumsum([params['total_planes'] for params in file_params])]).astype(int)
+        print("Indexed %d files: %d planes, %d spots." % \
+              (len(entries), plane_offsets[-1], sum([entry['spot_count'] for entry in entries])))
+
+        return file_params, plane_offsets[:-1]
+
+    def process_spots (self, input_filename, params, logs):
+        # read, chase, filter and consolidate spots of a file
+        spot_table = pandas.read_csv(input_filename, sep='\t', comment='#')
+        logs.append("Total %d spots in %s." % (len(spot_table), input_filename))
+
+        # chase if necessary
+        if self.chase_spots is True:
+            if 'distance' in spot_table.columns:
+                logs.append("Skip chasing in %s (already chased)." % (input_filename))
+            else:
+                spot_table = self.chaser.chase_spots(spot_table)
+                logs.append("Chaser detected %d unique spots." % (len(spot_table.total_index.unique())))
+
+        # omit spots contained in the last plane
+        if self.omit_lastplane_spots is True:
+            total_spots = len(spot_table)
+            spot_table = self.filter.omit_lastplane_spots(spot_table, params['total_planes'] - 1)
+            logs.append("Omitted %d spots contained in the last plane." % (total_spots - len(spot_table)))
+
+        # filter using lifetime of spots
+        if self.lifetime_range != [1, 0]:
+            total_spots = len(spot_table)
+            self.filter.lifetime_min = self.lifetime_range[0]
+            self.filter.lifetime_max = numpy.inf if self.lifetime_range[1] == 0 else self.lifetime_range[1]
+            spot_table = self.filter.filter_spots_lifetime(spot_table, params.get('sorted_by_track'))
+            if self.lifetime_range[1] == 0:
+                logs.append("Filtered %d of %d spots (%d %f)." % \
+                            (total_spots - len(spot_table), total_spots, self.filter.lifetime_min, self.filter.lifetime_max))
+            else:
+                logs.append("Filtered %d of %d spots (%d %d)." % \
+                            (total_spots - len(spot_table), total_spots, self.filter.lifetime_min, self.filter.lifetime_max))
+
+        # average cenroids
+        if self.consolidate_spots is True:
+            total_spots = len(spot_table)
+            if self.consolidate_mode == 'average':
+                spot_table = self.filter.average_spots(spot_table, params.get('sorted_by_track'))
+            elif self.consolidate_mode == 'first':
+                spot_table = self.filter.keep_first_spots(spot_table)
+            elif self.consolidate_mode == 'last':
+                spot_table = self.filter.keep_last_spots(spot_table)
+            else:
+                raise Exception('unknown consolidation mode')
+            logs.append("Consolidated (%s) to %d of %d spots." % (self.consolidate_mode, len(spot_table), total_spots))
+
+        return spot_table
+
+    def render_files (self, task):
+        # render files of a task into a partial accumulator of its own.
+        # the accumulator is cleared for each file in the separate mode (the last file is returned)
+        input_filenames, file_params, last_planes, image_size, clear_each = task
+        plotter = copy.copy(self.plotter)
+        plotter.init_image(image_size[0], image_size[1])
+
+        logs = []
+        for input_filename, params, last_plane in zip(input_filenames, file_params, last_planes):
+            if clear_each is True:
+                plotter.clear_image()
+            spot_table = self.process_spots(input_filename, params, logs)
+            plotter.plot_spots(last_plane, spot_table, self.drift)
+            logs.append("Plot %d spots (%d planes) from %s." % (len(spot_table), params['total_planes'], input_filename))
+            logs.append("--")
+
+        return plotter.plot_image, logs
+
+    def snapshot_indexes (self, file_count, stack_each):
+        # files whose images are saved in the stack (every stack_each files and the last file)
+        snapshots = numpy.arange(0, file_count, stack_each)
+        snapshots[-1] = file_count - 1
+        return snapshots
+
+    def map_tasks (self, tasks):
+        # results in the order of tasks. processes are forked if possible (threads otherwise)
+        if (self.workers <= 1) or (len(tasks) <= 1):
+            for task in tasks:
+                yield self.render_files(task)
+        elif 'fork' in multiprocessing.get_all_start_methods():
+            with ProcessPoolExecutor(max_workers = self.workers, mp_context = multiprocessing.get_context('fork')) as executor:
+                for result in executor.map(self.render_files, tasks):
+                    yield result
+        else:
+            with ThreadPoolExecutor(max_workers = self.workers) as executor:
+                for result in executor.map(self.render_files, tasks):
+                    yield result
+
+    def render (self, input_filenames, image_size, stack_mode = None, stack_each = 1):
+        # render all files into an image (or a stack for the separate and cumulative modes)
+        file_params, last_planes = self.read_file_params(input_filenames)
+        file_count = len(input_filenames)
+
+        # tasks of contiguous files
+        if stack_mode is None:
+            bounds = numpy.linspace(0, file_count, min(max(1, self.workers), file_count) + 1).astype(int)
+        elif stack_mode in self.stack_modes:
+            bounds = numpy.concatenate([[0], self.snapshot_indexes(file_count, stack_each) + 1])
+        else:
+            raise Exception('unknown stack mode')
+        tasks = [(input_filenames[start:end], file_params[start:end], last_planes[start:end], \
+                  image_size, stack_mode == 'separate') for start, end in zip(bounds[:-1], bounds[1:])]
+
+        # sum partial accumulators (the accumulator of the first task is reused).
+        # stack is a list of images (dense arrays or tile images)
+        output_image = None
+        output_stack = []
+        for plot_image, logs in self.map_tasks(tasks):
+            print('\n'.join(logs))
+            if output_image is None:
+                output_image = plot_image
+            elif stack_mode != 'separate':
+                output_image += plot_image
+
+            if stack_mode == 'separate':
+                output_stack.append(plot_image)
+            elif stack_mode == 'cumulative':
+                output_stack.append(output_image.copy())
+
+        if stack_mode is None:
+            return output_image
+        else:
+            return output_stack
+
+    def render_windows (self, input_filenames, image_size, window_size, window_step):
+        # images of time windows (window_size planes every window_step planes through all files) in a pass.
+        # returns the number of windows and an iterator yielding each window when its files are processed
+        file_params, last_planes = self.read_file_params(input_filenames)
+        total_planes = last_planes[-1] + file_params[-1]['total_planes']
+        window_count = int(max(0, total_planes - window_size) // window_step + 1)
+
+        def window_images ():
+            windows = {}
+            next_window = 0
+            for input_filename, params, last_plane in zip(input_filenames, file_params, last_planes):
+                logs = []
+                spot_table = self.process_spots(input_filename, params, logs)
+                print('\n'.join(logs))
+
+                # plot spots into windows containing them (windows are allocated when used)
+                planes = spot_table['plane'].values + last_plane
+                if len(planes) > 0:
+                    first_window = max(0, -(-(planes.min() - window_size + 1) // window_step))
+                    last_window = min(window_count - 1, planes.max() // window_step)
+                    for index in range(first_window, last_window + 1):
+                        start = index * window_step
+                        in_window = (start <= planes) & (planes < start + window_size)
+                        if numpy.count_nonzero(in_window) == 0:
+                            continue
+                        if index not in windows:
+                            windows[index] = self.plotter.init_image(image_size[0], image_size[1])
+                        self.plotter.plot_image = windows[index]
+                        self.plotter.plot_spots(last_plane, spot_table[in_window], self.drift)
+
+                print("Plot %d spots (%d planes) from %s." % (len(spot_table), params['total_planes'], input_filename))
+                print("--")
+
+                # windows completed in this file
+                file_end = last_plane + params['total_planes']
+                while (next_window < window_count) and (next_window * window_step + window_size <= file_end):
+                    yield self.window_image(windows, next_window, image_size)
+                    next_window += 1
+
+            # windows left (the last window may be shorter than window_size)
+            while next_window < window_count:
+                yield self.window_image(windows, next_window, image_size)
+                next_window += 1
+
+        return window_count, window_images()
+
+    def window_image (self, windows, index, image_size):
+        # release a window (an empty image if no spots were plotted)
+        if index in windows:
+            return windows.pop(index)
+        return self.plotter.init_image(image_size[0], image_size[1])
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+import sys, threading, queue, collections, heapq, tempfile, numpy, pandas
+from concurrent.futures import ThreadPoolExecutor
+from taniclass import nnchaser, trackindex
+
+class SpotStream:
+    def __init__ (self, tracer, chaser = None, filter = None):
+        self.tracer = tracer
+        self.chaser = chaser
+        self.filter = filter
+        self.queue_size = 16 # planes (or chunks) buffered between stages
+        self.chunk_size = 10000 # spots written into the tsv file at once
+        self.spill_size = 100000 # finished spots held back in memory before they are spilled to sorted runs
+        self.spill_directory = None # directory of temporary runs (default of the system if None)
+
+        # statistics
+        self.spot_counts = []
+        self.error_sum = {}
+        self.total_spots = 0
+        self.chased_spots = 0
+        self.output_spots = 0
+        self.max_held_spots = 0
+        self.spilled_runs = 0
+
+        # temporary files of sorted runs merged into the tsv file at the end
+        self.run_files = []
+
+        # exceptions raised in the threads of stages
+        self.errors = []
+
+    def columns (self):
+        if self.chaser is None:
+            return self.tracer.columns
+        else:
+            return self.tracer.columns + ['distance', 'life_index', 'life_total']
+
+    def read_planes (self, image_source, plane_queue):
+        # stage 1: read (decode) planes
+        try:
+            for index in range(len(image_source)):
+                plane_queue.put((index, numpy.array(image_source[index])))
+        except Exception as exception:
+            self.errors.append(exception)
+
+        plane_queue.put(None)
+
+    def fit_planes (self, plane_queue, result_queue):
+        # stage 2: filter and fitting on a thread pool (results are passed in the order of planes)
+        thread_data = threading.local()
+        futures = collections.deque()
+        finished = False
+
+        try:
+            with ThreadPoolExecutor(max_workers = max(1, self.tracer.workers)) as executor:
+                while True:
+                    item = plane_queue.get()
+                    if item is None:
+                        finished = True
+                        break
+
+                    index, plane = item
+                    futures.append(executor.submit(self.tracer.fitting_plane, plane, index, thread_data))
+                    while (len(futures) > 0) and (futures[0].done() or len(futures) > self.queue_size):
+                        result_queue.put(futures.popleft().result())
+
+                while len(futures) > 0:
+                    result_queue.put(futures.popleft().result())
+
+        except Exception as exception:
+            self.errors.append(exception)
+            # release the reader
+            while finished is False:
+                finished = (plane_queue.get() is None)
+
+        result_queue.put(None)
+
+    def chase_planes (self, result_queue, chunk_queue):
+        # stage 3: index and chase spots, then pass chunks of finished tracks to the writer
+        online_chaser = None if self.chaser is None else nnchaser.OnlineChaser(self.chaser)
+        pending_tables = []
+        pending_spots = 0
+        new_spots = 0
+
+        while True:
+            item = result_queue.get()
+            if item is None:
+                break
+
+            # sum error spots
+            result, error = item
+            for key in error.keys():
+                self.error_sum[key] = self.error_sum.get(key, 0) + error[key]
+
+            # make pandas table (total_index is numbered through planes)
+            length = len(result['plane'])
+            result.update({'total_index': numpy.arange(length) + self.total_spots})
+            spot_table = pandas.DataFrame(result, columns = self.tracer.columns)
+            self.spot_counts.append(length)
+            self.total_spots += length
+
+            # chase spots. tracks are finished when they are not linked within max_gap planes
+            limit_index = numpy.inf
+            if online_chaser is not None:
+                spot_table, output_table = online_chaser.push_plane(spot_table)
+                limit_index = online_chaser.first_active_index()
+            else:
+                output_table = spot_table
+
+            # pass finished spots when enough spots are newly finished
+            # finished spots in memory are at most spill_size + chunk_size (and the spots finished on a plane)
+            if (output_table is not None) and (len(output_table) > 0):
+                pending_tables.append(output_table)
+                pending_spots += len(output_table)
+                new_spots += len(output_table)
+                self.max_held_spots = max(self.max_held_spots, pending_spots)
+
+            if new_spots >= self.chunk_size:
+                pending_tables, pending_spots = self.flush_tables(pending_tables, limit_index, chunk_queue)
+                new_spots = 0
+
+        # pass all the remaining spots
+        if online_chaser is not None:
+            output_table = online_chaser.finish()
+            if output_table is not None:
+                pending_tables.append(output_table)
+        self.flush_tables(pending_tables, numpy.inf, chunk_queue)
+
+    def flush_tables (self, pending_tables, limit_index, chunk_queue):
+        if len(pending_tables) == 0:
+            return [], 0
+
+        spot_table = pandas.concat(pending_tables, ignore_index = True)
+
+        # finished tracks are passed in the order of total_index. tracks numbered
+        # after the oldest active track (limit_index) have to wait for it, so one
+        # long track can hold back all the tracks finished during its life.
+        # more than spill_size spots held back are spilled to a sorted run, and all
+        # the following spots go to runs of spill_size spots (merged in run()).
+        run_file = None
+        if self.chaser is not None:
+            spot_table = trackindex.TrackIndex(spot_table).sorted_table
+            if len(self.run_files) == 0:
+                passed = (spot_table['total_index'] < limit_index)
+                if numpy.count_nonzero(~passed) > self.spill_size:
+                    self.pass_table(spot_table[passed], None, chunk_queue)
+                    spot_table = spot_table[~passed]
+                    passed = numpy.ones(len(spot_table), dtype=bool)
+                    run_file = self.new_run()
+            elif (len(spot_table) >= self.spill_size) or (limit_index == numpy.inf):
+                passed = numpy.ones(len(spot_table), dtype=bool)
+                run_file = self.new_run()
+            else:
+                passed = numpy.zeros(len(spot_table), dtype=bool)
+            output_table = spot_table[passed]
+            spot_table = spot_table[~passed].reset_index(drop=True)
+        else:
+            output_table = spot_table
+            spot_table = spot_table.iloc[0:0]
+
+        self.pass_table(output_table, run_file, chunk_queue)
+
+        if len(spot_table) > 0:
+            return [spot_table], len(spot_table)
+        else:
+            return [], 0
+
+    def new_run (self):
+        run_file = tempfile.TemporaryFile(mode = 'w+', newline = '', dir = self.spill_directory)
+        self.run_files.append(run_file)
+        self.spilled_runs += 1
+        return run_file
+
+    def pass_table (self, output_table, run_file, chunk_queue):
+        # pass spots to the writer (into the tsv file, or a run if run_file is given)
+        if self.chaser is not None:
+            self.chased_spots += numpy.sum(output_table['life_index'] == 0)
+
+        # use mask image to filter spots
+        if (self.filter is not None) and (self.filter.mask_image_filename is not None):
+            output_table = self.filter.filter_spots_maskimage(output_table)
+
+        chunk_queue.put((output_table, run_file))
+
+    def write_chunks (self, output_file, chunk_queue):
+        # stage 4: write chunks into the tsv file
+        failed = False
+        while True:
+            item = chunk_queue.get()
+            if item is None:
+                break
+            if failed is True:
+                continue
+
+            output_table, run_file = item
+            try:
+                output_table.to_csv(output_file if run_file is None else run_file, columns = output_table.columns, \
+                                    sep='\t', index = False, header = False, mode = 'a')
+                self.output_spots += len(output_table)
+            except Exception as exception:
+                self.errors.append(exception)
+                failed = True
+
+    def run (self, image_source, output_file):
+        plane_queue = queue.Queue(maxsize = self.queue_size)
+        result_queue = queue.Queue(maxsize = self.queue_size)
+        chunk_queue = queue.Queue(maxsize = self.queue_size)
+
+        threads = [threading.Thread(target = self.read_planes, args = (image_source, plane_queue), daemon = True), \
+                   threading.Thread(target = self.fit_planes, args = (plane_queue, result_queue), daemon = True), \
+                   threading.Thread(target = self.write_chunks, args = (output_file, chunk_queue), daemon = True)]
+        for thread in threads:
+            thread.start()
+
+        # chase in this thread
+        self.chase_planes(result_queue, chunk_queue)
+        chunk_queue.put(None)
+
+        for thread in threads:
+            thread.join()
+
+        try:
+            if len(self.errors) > 0:
+                raise self.errors[0]
+            self.merge_runs(output_file)
+        finally:
+            for run_file in self.run_files:
+                run_file.close()
+            self.run_files = []
+
+    def run_key (self, line):
+        # rows are sorted by total_index and plane (the first two columns)
+        total_index, plane = line.split('\t', 2)[0:2]
+        return int(total_index), int(plane)
+
+    def merge_runs (self, output_file):
+        # merge sorted runs into the tsv file (rows of runs follow the rows written directly)
+        if len(self.run_files) == 0:
+            return
+
+        for run_file in self.run_files:
+            run_file.seek(0)
+        output_file.writelines(heapq.merge(*self.run_files, key = self.run_key))
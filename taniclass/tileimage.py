@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+import sys, numpy
+
+class TileImage:
+    def __init__ (self, shape, tile_size = 256, dtype = numpy.int64):
+        # image of shape (height, width) made of square tiles allocated when touched
+        if (tile_size <= 0) or (tile_size % 16 != 0):
+            raise Exception('tile size must be a positive multiple of 16')
+
+        self.shape = tuple(shape)
+        self.tile_size = tile_size
+        self.grid_shape = ((self.shape[0] - 1) // tile_size + 1, (self.shape[1] - 1) // tile_size + 1)
+        self.tiles = {}
+        self.dtype = numpy.dtype(dtype)
+
+    def tile (self, tile_index):
+        # allocate a tile if necessary
+        if tile_index not in self.tiles:
+            self.tiles[tile_index] = numpy.zeros((self.tile_size, self.tile_size), dtype=self.dtype)
+        return self.tiles[tile_index]
+
+    def fill (self, value):
+        if value != 0:
+            raise Exception('tiles can be filled only with zero')
+        self.tiles = {}
+
+    def add_pixels (self, pixel_y, pixel_x, weights = None):
+        # add counts (or weights) of pixels (inside the image) into tiles
+        if len(pixel_y) == 0:
+            return
+
+        # unique pixels as (tile, position in the tile) sorted by tiles
+        size = self.tile_size
+        tile_indexes = (pixel_y // size) * self.grid_shape[1] + (pixel_x // size)
+        keys = tile_indexes * (size * size) + (pixel_y % size) * size + (pixel_x % size)
+        keys, inverse = numpy.unique(keys, return_inverse = True)
+        counts = numpy.bincount(inverse, weights = weights).astype(self.dtype)
+        tile_indexes = keys // (size * size)
+        positions = keys % (size * size)
+
+        # add counts tile by tile
+        firsts = numpy.flatnonzero(numpy.concatenate([[True], tile_indexes[1:] != tile_indexes[:-1]]))
+        lasts = numpy.append(firsts[1:], len(keys))
+        for first, last in zip(firsts, lasts):
+            self.tile(int(tile_indexes[first])).reshape(-1)[positions[first:last]] += counts[first:last]
+
+    def __iadd__ (self, other):
+        for tile_index, tile in other.tiles.items():
+            self.tile(tile_index)[:] += tile
+        return self
+
+    def copy (self):
+        tile_image = TileImage(self.shape, self.tile_size, self.dtype)
+        tile_image.tiles = {tile_index: tile.copy() for tile_index, tile in self.tiles.items()}
+        return tile_image
+
+    def asarray (self):
+        image = numpy.zeros((self.grid_shape[0] * self.tile_size, self.grid_shape[1] * self.tile_size), dtype=self.dtype)
+        for tile_index, tile in self.tiles.items():
+            tile_y, tile_x = divmod(tile_index, self.grid_shape[1])
+            image[tile_y * self.tile_size:(tile_y + 1) * self.tile_size, \
+                  tile_x * self.tile_size:(tile_x + 1) * self.tile_size] = tile
+        return image[:self.shape[0], :self.shape[1]]
+
+    def clipped_tiles (self, dtype):
+        # all tiles (empty tiles are zero) in the order of TIFF, clipped to dtype
+        zero_tile = numpy.zeros((self.tile_size, self.tile_size), dtype=dtype)
+        max_value = numpy.iinfo(dtype).max if numpy.dtype(dtype).kind in 'iu' else None
+        for tile_index in range(self.grid_shape[0] * self.grid_shape[1]):
+            if tile_index in self.tiles:
+                yield self.tiles[tile_index].clip(0, max_value).astype(dtype)
+            else:
+                yield zero_tile
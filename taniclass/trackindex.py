@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+import sys, numpy
+
+class TrackIndex:
+    def __init__ (self, spot_table, is_sorted = None):
+        # is_sorted: whether spot_table is sorted by (total_index, plane) (checked if None)
+        if is_sorted is None:
+            is_sorted = self.check_sorted(spot_table)
+
+        # sort only if necessary
+        if is_sorted is True:
+            self.sorted_table = spot_table.reset_index(drop=True)
+        else:
+            self.sorted_table = spot_table.iloc[self.sort_order(spot_table)].reset_index(drop=True)
+
+        # offsets (CSR-style) of tracks in the sorted table
+        total_indexes = self.sorted_table['total_index'].values
+        if len(total_indexes) > 0:
+            boundaries = numpy.flatnonzero(total_indexes[1:] != total_indexes[:-1]) + 1
+            self.track_offsets = numpy.concatenate([[0], boundaries, [len(total_indexes)]]).astype(int)
+        else:
+            self.track_offsets = numpy.zeros(1, dtype=int)
+        self.track_counts = numpy.diff(self.track_offsets)
+        self.total_indexes = total_indexes[self.track_offsets[:-1]]
+
+    def check_sorted (self, spot_table):
+        total_indexes = spot_table['total_index'].values
+        planes = spot_table['plane'].values
+        later_track = (total_indexes[1:] > total_indexes[:-1])
+        same_track = (total_indexes[1:] == total_indexes[:-1])
+        return bool(numpy.all(later_track | (same_track & (planes[1:] > planes[:-1]))))
+
+    def sort_order (self, spot_table):
+        total_indexes = spot_table['total_index'].values.astype(numpy.int64)
+        planes = spot_table['plane'].values.astype(numpy.int64)
+
+        # sorting a single key is faster than lexsort if the key does not overflow
+        total_range = total_indexes.max() - total_indexes.min() + 1
+        plane_range = planes.max() - planes.min() + 1
+        if total_range < (2 ** 62) // plane_range:
+            return numpy.argsort((total_indexes - total_indexes.min()) * plane_range + (planes - planes.min()))
+        else:
+            return numpy.lexsort((planes, total_indexes))
+
+    def first_positions (self):
+        return self.track_offsets[:-1]
+
+    def last_positions (self):
+        return self.track_offsets[1:] - 1
+
+    def life_indexes (self):
+        # index of each spot in its track
+        return numpy.arange(len(self.sorted_table)) - numpy.repeat(self.track_offsets[:-1], self.track_counts)
+
+    def life_totals (self):
+        # number of spots in the track of each spot
+        return numpy.repeat(self.track_counts, self.track_counts)
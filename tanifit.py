@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 import os, platform, sys, argparse, numpy, itertools, tifffile
-from taniclass import gaussian8, spotmarker
+from taniclass import gaussian8, spotmarker, imagesource
 from PIL import Image, ImageDraw, ImageFont
 
 # prepare tracing library
@@ -102,9 +102,11 @@ if args.threshold_abs_range is not None:
     threshold_abses = numpy.arange(*args.threshold_abs_range)
 
 # read image (one plane only)
-orig_image = tifffile.imread(input_filename)
-if len(orig_image.shape) > 2:
-    orig_image = orig_image[use_plane]
+orig_images = imagesource.ImageSource(input_filename)
+if len(orig_images) > 1:
+    orig_image = orig_images[use_plane]
+else:
+    orig_image = orig_images[0]
 
 # image clip
 tracer.set_image_clip(orig_image)
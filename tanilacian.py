@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 import os, sys, argparse, numpy, tifffile
-from taniclass import gaussian8
+from taniclass import gaussian8, imagesource
 
 # classes
 tracer = gaussian8.Gaussian8()
@@ -37,16 +37,14 @@ else:
     output_filename = args.output_file[0]
 
 # read image
-orig_images = tifffile.imread(input_filename)
-if len(orig_images.shape) == 2:
-    orig_images = numpy.array([orig_images])
-
-# apply log filter
-float_images = numpy.array(orig_images, 'f')
-tracer.set_image_clip(orig_images)
-float_images = tracer.clip_array(float_images)
-for index in range(len(float_images)):
-    float_images[index] = tracer.standardize_and_filter_image(float_images[index])
+orig_images = imagesource.ImageSource(input_filename)
+
+# apply log filter plane by plane
+tracer.set_image_clip(orig_images.asarray())
+float_images = numpy.zeros(orig_images.shape, dtype = numpy.float32)
+workspace = numpy.empty((2,) + orig_images.shape[1:], dtype = numpy.float32)
+for index in range(len(orig_images)):
+    float_images[index] = tracer.filter_plane(orig_images[index], workspace)
 
 # prepare image of 8-bit RGB color
 float_max = numpy.max(float_images)
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
-import os, sys, argparse, pandas, numpy, tifffile
-from taniclass import spotmarker, spotfilter
+import os, sys, argparse, pandas
+from taniclass import spotmarker, spotfilter, imagesource
 
 # prepare spot marker
 marker = spotmarker.SpotMarker()
@@ -76,13 +76,8 @@ else:
 if args.mask_image is not None:
     filter.mask_image_filename = args.mask_image[0]
 
-# read image
-orig_image = tifffile.imread(input_filename)
-if len(orig_image.shape) == 2:
-    orig_image = numpy.array([orig_image])
-
-# convert image to 8-bit RGB color
-image_color = marker.convert_to_color(orig_image)
+# open image (planes are read when marked)
+orig_image = imagesource.ImageSource(input_filename)
 
 # read results
 print("Read spots from %s." % (marker_filename))
@@ -94,10 +89,7 @@ if filter.mask_image_filename is not None:
     spot_table = filter.filter_spots_maskimage(spot_table)
     print("Filtered %d spots using a mask image: %s." % (total_spots - len(spot_table), filter.mask_image_filename))
 
-# mark tracking status
+# mark tracking status and output multipage tiff (8-bit RGB color) chunk by chunk
 print("Marked %d spots on %s." % (len(spot_table), input_filename))
-image_color = marker.mark_spots(image_color, spot_table)
-
-# output multipage tiff
 print("Output image file to %s." % (output_filename))
-tifffile.imwrite(output_filename, image_color)
+marker.write_marked_movie(output_filename, orig_image, spot_table)
@@ -1,13 +1,14 @@
 #!/usr/bin/env python
 
 import os, platform, sys, glob, argparse, time
-import pandas, numpy, tifffile
-from taniclass import spotplotter, nnchaser, spotfilter
+import pandas, numpy
+from taniclass import spotplotter, nnchaser, spotfilter, spotrender
 
 # prepare classes
 plotter = spotplotter.SpotPlotter()
 chaser = nnchaser.NNChaser()
 filter = spotfilter.SpotFilter()
+render = spotrender.SpotRender(plotter, chaser, filter)
 
 # defaults
 input_filenames = None
@@ -17,6 +18,7 @@ align_filename = 'align.txt'
 output_filename = 'plot_%s.tif' % time.strftime("%Y-%m-%d_%H-%M-%S")
 output_stackmode = None
 output_stackeach = 1
+time_window = None
 chase_spots = False
 lifetime_range = [1, 0]
 consolidate_spots = False
@@ -38,8 +40,21 @@ parser.add_argument('-a', '--align-file', nargs=1, default=[align_filename], \
 parser.add_argument('-e', '--align-each', nargs=1, type=int, default=[plotter.align_each], \
                     help='apply drift correction every X frames')
 
+parser.add_argument('-D', '--drift-model', nargs=1, default=[plotter.drift_model], \
+                    choices = plotter.drift_models, \
+                    help='drift of each spot (step: constant every X frames, linear or spline: interpolated)')
+
 parser.add_argument('-X', '--image-scale', nargs=1, type=int, default=[plotter.image_scale], \
                     help='scale factor to original image')
+parser.add_argument('-p', '--plot-mode', nargs=1, default=[plotter.plot_mode], \
+                    choices = plotter.plot_modes, \
+                    help='plot each spot as a pixel (point) or as normalized splats at subpixel positions (bilinear, gaussian)')
+parser.add_argument('-k', '--splat-sigma', nargs=1, type=float, default=[plotter.splat_sigma], \
+                    help='sigma of gaussian splats (pixel of the original image)')
+parser.add_argument('-K', '--splat-column', nargs=1, default=[plotter.splat_column], \
+                    help='column of spot tables used as sigma of gaussian splats (instead of -k)')
+parser.add_argument('-b', '--tile-size', nargs=1, type=int, default=[plotter.tile_size], \
+                    help='accumulate spots in tiles allocated when used and output tiled BigTIFF (0 for dense images)')
 parser.add_argument('-Z', '--image-size', nargs=2, type=int, default=image_size, \
                     metavar=('WIDTH', 'HEIGHT'), \
                     help='size of original image (read from first file if not specified)')
@@ -56,6 +71,9 @@ group.add_argument('-T', '--seperate-stack', action='store_const', \
 group.add_argument('-U', '--cumulative-stack', action='store_const', \
                     dest='output_stackmode', const='cumulative', \
                     help='reconstruct image for each file, but cumulatively')
+group.add_argument('-W', '--time-window', nargs=2, type=int, default=time_window, \
+                    metavar=('WINDOW', 'STEP'), \
+                    help='reconstruct images of WINDOW frames every STEP frames (through all files)')
 
 parser.add_argument('-E', '--stack-each', nargs=1, type=int, default=[output_stackeach], \
                     help='reconstruct image for each X file (requires -T or -U)')
@@ -73,6 +91,12 @@ parser.add_argument('-m', '--consolidate-mode', nargs=1, default=[consolidate_mo
 parser.add_argument('-t', '--omit-lastframe-spots', action='store_true', default=omit_lastplane_spots, \
                     help='omit spots that is contained in the last frame (omit spots of unclear lifetime)')
 
+parser.add_argument('--no-index', action='store_true', default=(plotter.header_index.use_index is False), \
+                    help='read headers of all files without caching them in %s of each directory' % (plotter.header_index.index_filename))
+
+parser.add_argument('-j', '--workers', nargs=1, type=int, default=[render.workers], \
+                    help='number of processes to read and plot files in parallel')
+
 parser.add_argument('input_file', nargs='+', default=None, \
                     help='input TSV file(s) of fluorescent spots')
 
@@ -94,10 +118,16 @@ align_filename = args.align_file[0]
 image_size = args.image_size
 output_stackmode = args.output_stackmode
 output_stackeach = args.stack_each[0]
+time_window = args.time_window
 output_filename = args.output_file[0]
 
 plotter.align_each = args.align_each[0]
+plotter.drift_model = args.drift_model[0]
 plotter.image_scale = args.image_scale[0]
+plotter.tile_size = args.tile_size[0]
+plotter.plot_mode = args.plot_mode[0]
+plotter.splat_sigma = args.splat_sigma[0]
+plotter.splat_column = args.splat_column[0]
 chase_spots = args.chase_spots
 chaser.chase_distance = args.chase_distance[0]
 
@@ -107,6 +137,14 @@ consolidate_mode = args.consolidate_mode[0]
 
 omit_lastplane_spots = args.omit_lastframe_spots
 
+render.workers = args.workers[0]
+plotter.header_index.use_index = (args.no_index is False)
+render.chase_spots = chase_spots
+render.lifetime_range = lifetime_range
+render.consolidate_spots = consolidate_spots
+render.consolidate_mode = consolidate_mode
+render.omit_lastplane_spots = omit_lastplane_spots
+
 # read align table
 if align_spots is True:
     if os.path.isfile(align_filename) is False:
@@ -115,6 +153,7 @@ if align_spots is True:
     print("Using %s for alignment." % (align_filename))
 else:
     align_table = None
+render.drift = plotter.fit_drift(align_table)
 
 # read first table and determine size
 if image_size is None:
@@ -122,97 +161,28 @@ if image_size is None:
 else:
     width, height = image_size[0], image_size[1]
 
-# prepare output image
-output_image = numpy.zeros((height * plotter.image_scale, width * plotter.image_scale), dtype=numpy.int64)
-if output_stackmode is not None:
-    stack_size = ((len(input_filenames) - 1) // output_stackeach) + 1
-    output_stack = numpy.zeros((stack_size, \
-                                height * plotter.image_scale, width * plotter.image_scale), \
-                                dtype=numpy.int64)
-
-# plot spots for each table
-last_plane = 0
-
-for index, input_filename in enumerate(input_filenames):
-    # init output image for separate stack
-    if output_stackmode == 'separate':
-        output_image.fill(0)
-
-    # get parameters and spots
-    params = plotter.read_image_params(input_filename)
-    spot_table = pandas.read_csv(input_filename, sep='\t', comment='#')
-    print("Total %d spots in %s." % (len(spot_table), input_filename))
-
-    # chase if necessary
-    if chase_spots is True:
-        if 'distance' in spot_table.columns:
-            print("Skip chasing in %s (already chased)." % (input_filename))
-        else:
-            spot_table = chaser.chase_spots(spot_table)
-            print("Chaser detected %d unique spots." % (len(spot_table.total_index.unique())))
-
-    # omit spots contained in the last plane
-    if omit_lastplane_spots is True:
-        total_spots = len(spot_table)
-        spot_table = filter.omit_lastplane_spots(spot_table, params['total_planes'] - 1)
-        print("Omitted %d spots contained in the last plane." % (total_spots - len(spot_table)))
-
-    # filter using lifetime of spots
-    if lifetime_range != [1, 0]:
-        total_spots = len(spot_table)
-        filter.lifetime_min = lifetime_range[0]
-        filter.lifetime_max = numpy.inf if lifetime_range[1] == 0 else lifetime_range[1]
-        spot_table = filter.filter_spots_lifetime(spot_table)
-        if lifetime_range[1] == 0:
-            print("Filtered %d of %d spots (%d %f)." % \
-                    (total_spots - len(spot_table), total_spots, filter.lifetime_min, filter.lifetime_max))
-        else:
-            print("Filtered %d of %d spots (%d %d)." % \
-                    (total_spots - len(spot_table), total_spots, filter.lifetime_min, filter.lifetime_max))
-
-    # average cenroids
-    if consolidate_spots is True:
-        total_spots = len(spot_table)
-        if consolidate_mode == 'average':
-            spot_table = filter.average_spots(spot_table)
-        elif consolidate_mode == 'first':
-            spot_table = filter.keep_first_spots(spot_table)
-        elif consolidate_mode == 'last':
-            spot_table = filter.keep_last_spots(spot_table)
-        else:
-            raise Exception('unknown consolidation mode')
-        print("Consolidated (%s) to %d of %d spots." % (consolidate_mode, len(spot_table), total_spots))
-
-    # plot
-    #print(spot_table)
-    output_image = plotter.plot_spots(output_image, last_plane, spot_table, align_table)
-
-    # save into stack
-    if output_stackmode is not None:
-        if index % output_stackeach == 0:
-            output_stack[index // output_stackeach] = output_image
-
-    last_plane += params['total_planes']
-
-    print("Plot %d spots (%d planes) from %s." % (len(spot_table), params['total_planes'], input_filename))
-    print("--")
-
-# save into last stack
-if output_stackmode is not None:
-    if index % output_stackeach != 0:
-        output_stack[-1] = output_image
-
+# render spots of all tables (files are partitioned into processes)
+if time_window is not None:
+    if (time_window[0] <= 0) or (time_window[1] <= 0):
+        raise Exception('window and step must be positive')
+    window_count, window_images = render.render_windows(input_filenames, [width, height], time_window[0], time_window[1])
+elif output_stackmode is None:
+    output_image = render.render(input_filenames, [width, height])
+else:
+    output_stack = render.render(input_filenames, [width, height], output_stackmode, output_stackeach)
 
 # output (multipage) tiff
 desc_text = 'output by %s (Daisuke Taniguchi and Takushi Miyoshi)' % (os.path.basename(__file__))
 
-if output_stackmode is None:
+if time_window is not None:
+    # images are rendered while output
+    print("Output %d time windows (%d frames every %d frames) to %s." % (window_count, time_window[0], time_window[1], output_filename))
+    plotter.write_images(output_filename, window_images, description = desc_text, image_count = window_count)
+elif output_stackmode is None:
     # clip output.tif to 32bit and output
     print("Output image file to %s." % (output_filename))
-    output_image_32bit = output_image.clip(0, numpy.iinfo(numpy.int32).max).astype(numpy.int32)
-    tifffile.imwrite(output_filename, output_image_32bit, description = desc_text)
+    plotter.write_images(output_filename, output_image, description = desc_text)
 else:
     # clip output.tif to 32bit and output
     print("Output %s stack image file to %s." % (output_stackmode, output_filename))
-    output_image_32bit = output_stack.clip(0, numpy.iinfo(numpy.int32).max).astype(numpy.int32)
-    tifffile.imwrite(output_filename, output_image_32bit, description = desc_text)
+    plotter.write_images(output_filename, output_stack, description = desc_text)
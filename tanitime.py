@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 import os, sys, argparse, pandas, numpy
-from taniclass import spotplotter
+from taniclass import spotplotter, planeindex, trackindex
 
 plotter = spotplotter.SpotPlotter()
 
@@ -107,9 +107,9 @@ else:
     width, height = plotter.read_image_size(input_filename)
     center_x, center_y = [edge_width, height - edge_width], [edge_width, width - edge_width]
 
-# read results, sort, and RESET index (important)
+# read results, sort (skipped if sorted), and RESET index (important)
 spot_table = pandas.read_csv(input_filename, comment = '#', sep = '\t')
-spot_table = spot_table.sort_values(by = ['total_index', 'plane']).reset_index(drop=True)
+spot_table = trackindex.TrackIndex(spot_table).sorted_table
 
 print(center_x, center_y)
 
@@ -120,11 +120,15 @@ if selected_mode == 'regression':
                                 (center_x[0] <= spot_table.x) & (spot_table.x < center_x[1]) & \
                                 (center_y[0] <= spot_table.y) & (spot_table.y < center_y[1])].total_index.tolist())
 
+    # count spots in each plane at once
+    counted_table = spot_table[spot_table.total_index.isin(index_set)]
+    plane_counts = planeindex.PlaneIndex(counted_table, spot_table.plane.max() + 1).plane_counts
+
     # regression
     output_indexes = []
     output_counts = []
     for index in range(start_regression, spot_table.plane.max() + 1):
-        spot_count = len(spot_table[(spot_table.total_index.isin(index_set)) & (spot_table.plane == index)])
+        spot_count = plane_counts[index]
         if spot_count == 0:
             break
         output_indexes += [index - start_regression]
@@ -160,7 +164,8 @@ elif selected_mode == 'counting':
     plane_max = spot_table.plane.max()
     output_indexes = [i for i in range(1, plane_max + 1)]
     output_times = [i * time_scale for i in output_indexes]
-    output_counts = [len(spot_table[spot_table.plane == i]) for i in output_indexes]
+    plane_counts = planeindex.PlaneIndex(spot_table).plane_counts
+    output_counts = [plane_counts[i] for i in output_indexes]
     output_ratios = numpy.array(output_counts) / numpy.sum(numpy.array(output_counts))
 
 else:
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
-import os, sys, argparse, numpy, matplotlib, tifffile
-from taniclass import gaussian8, nnchaser, spotmarker, spotplotter, spotfilter
+import os, sys, argparse, numpy, pandas, matplotlib
+from taniclass import gaussian8, nnchaser, spotmarker, spotplotter, spotfilter, imagesource, spotstream, planeindex
 
 # prepare library instances
 tracer = gaussian8.Gaussian8()
@@ -17,6 +17,7 @@ output_tsv_filename = None
 output_image_filename = None
 chase_spots = False
 output_image = False
+stream_mode = False
 
 # parse arguments
 parser = argparse.ArgumentParser(description='Detect fluorescent spots with Gaussian fitting.', \
@@ -43,10 +44,28 @@ parser.add_argument('-x', '--max-diameter', nargs=1, type=float, default=[tracer
 parser.add_argument('-u', '--dup-threshold', nargs=1, type=float, default=[tracer.dup_threshold], action='append',\
                     help='minimum distance to distinguish two spots (to avoid redundant detection)')
 
+parser.add_argument('-j', '--workers', nargs=1, type=int, default=[tracer.workers], \
+                    help='number of threads to process planes in parallel')
+
+parser.add_argument('-S', '--stream', action='store_true', default=stream_mode, \
+                    help='read, fit, chase and output spots plane by plane in bounded memory')
+
 parser.add_argument('-C', '--chase-spots', action='store_true', default=chase_spots, \
                     help='chase spots using k-Nearest Neighbor algorithm')
 parser.add_argument('-d', '--chase-distance', nargs=1, type=float, default = [chaser.chase_distance], action='append',\
                     help='maximum distance to assume as identical spots (pixel)')
+parser.add_argument('--linker', nargs=1, type=str, default = [chaser.linker], action='append', \
+                    choices = chaser.linkers, \
+                    help='link spots to nearest neighbors (nn) or by globally optimal assignment (lap)')
+parser.add_argument('-g', '--max-gap', nargs=1, type=int, default = [chaser.max_gap], action='append', \
+                    help='maximum number of planes that tracks can skip (missed detection)')
+parser.add_argument('--predictor', nargs=1, type=str, default = [chaser.predictor], action='append', \
+                    choices = chaser.predictors, \
+                    help='predict positions of tracks (kalman: constant velocity) to search spots within adaptive gates')
+parser.add_argument('--position-noise', nargs=1, type=float, default = [chaser.position_noise], action='append', \
+                    help='localization error of spots for the predictor (pixel)')
+parser.add_argument('--velocity-noise', nargs=1, type=float, default = [chaser.velocity_noise], action='append', \
+                    help='change of velocity in a plane for the predictor (pixel/plane)')
 
 parser.add_argument('-O', '--output-image', action='store_true', default=output_image, \
                     help='output TIFF file with markers of detected spots')
@@ -83,10 +102,10 @@ else:
 
 # load options from the previous result
 if args.rerun is True:
-    args.import_settings_file = os.path.splitext(os.path.basename(input_filename))[0] + '.txt'
+    args.import_settings_file = [os.path.splitext(os.path.basename(input_filename))[0] + '.txt']
 
 if args.import_settings_file is not None:
-    import_settings_filename = args.import_settings_file
+    import_settings_filename = args.import_settings_file[0]
     print("Importing settings: %s (can be overwritten by options)" % (import_settings_filename))
     fileext = os.path.splitext(os.path.basename(import_settings_filename))[1].lower()
     if (fileext == '.stk') or (fileext == '.tif'):
@@ -97,11 +116,15 @@ if args.import_settings_file is not None:
     # pretend as if options are set
     for key in params:
         if hasattr(args, key):
-            if len(getattr(args, key)) > 1:
-                print("Parameter %s was overwritten by options as %f" % (key, list(matplotlib.cbook.flatten(getattr(args, key)))[-1]))
+            if getattr(args, key) is None:
+                # options without defaults (mask image)
+                setattr(args, key, [params[key]])
+                print("Read parameter %s as %s" % (key, params[key]))
+            elif len(getattr(args, key)) > 1:
+                print("Parameter %s was overwritten by options as %s" % (key, list(matplotlib.cbook.flatten(getattr(args, key)))[-1]))
             else:
                 getattr(args, key).append(params[key])
-                print("Read parameter %s as %f" % (key, params[key]))
+                print("Read parameter %s as %s" % (key, params[key]))
         if key == 'chase_distance':
             chase_spots = True
             print("Spot chaser ON.")
@@ -111,9 +134,15 @@ tracer.min_distance = list(matplotlib.cbook.flatten(args.min_distance))[-1]
 tracer.threshold_abs = list(matplotlib.cbook.flatten(args.threshold_abs))[-1]
 tracer.max_diameter = list(matplotlib.cbook.flatten(args.max_diameter))[-1]
 tracer.dup_threshold = list(matplotlib.cbook.flatten(args.dup_threshold))[-1]
+tracer.workers = args.workers[0]
 
 chase_spots = (args.chase_spots | chase_spots)
 chaser.chase_distance = list(matplotlib.cbook.flatten(args.chase_distance))[-1]
+chaser.linker = list(matplotlib.cbook.flatten(args.linker))[-1]
+chaser.max_gap = list(matplotlib.cbook.flatten(args.max_gap))[-1]
+chaser.predictor = list(matplotlib.cbook.flatten(args.predictor))[-1]
+chaser.position_noise = list(matplotlib.cbook.flatten(args.position_noise))[-1]
+chaser.velocity_noise = list(matplotlib.cbook.flatten(args.velocity_noise))[-1]
 
 marker.marker_colors = args.marker_colors
 marker.marker_size = args.marker_size[0]
@@ -124,6 +153,7 @@ if args.mask_image is not None:
     filter.mask_image_filename = args.mask_image[0]
 
 output_image = args.output_image
+stream_mode = args.stream
 if args.output_image_file is None:
     output_image_filename = os.path.splitext(os.path.basename(input_filename))[0] + '_marked.tif'
     if input_filename == output_image_filename:
@@ -131,22 +161,61 @@ if args.output_image_file is None:
 else:
     output_image_filename = args.output_image_file[0]
 
-# read image
-orig_image = tifffile.imread(input_filename)
-if len(orig_image.shape) == 2:
-    orig_image = numpy.array([orig_image])
+# open image (planes are read when used)
+orig_image = imagesource.ImageSource(input_filename)
 print("Read image %s" % (input_filename))
 
 # image clip
 tracer.set_image_clip(orig_image[0])
 
+# streaming mode (output tsv file while fitting and chasing)
+if stream_mode is True:
+    streamer = spotstream.SpotStream(tracer, chaser if chase_spots is True else None, filter)
+
+    # open tsv file and output header
+    output_tsv_file = open(output_tsv_filename, 'w', newline='')
+    tracer.output_header(output_tsv_file, input_filename, orig_image)
+    if chase_spots is True:
+        chaser.output_header(output_tsv_file)
+    if filter.mask_image_filename is not None:
+        filter.output_header(output_tsv_file)
+    output_tsv_file.write('\t'.join(streamer.columns()) + '\n')
+
+    # run pipeline and close
+    streamer.run(orig_image, output_tsv_file)
+    output_tsv_file.close()
+
+    print("Dropped spots: %s" % (str(streamer.error_sum)))
+    if streamer.total_spots == 0:
+        os.remove(output_tsv_filename)
+        print("No spots detected. Quit.")
+        sys.exit()
+
+    print("Detected spots: %s" % (' '.join(map(str, streamer.spot_counts))))
+    print("Total %d spots detected in %d frames." % (streamer.total_spots, len(orig_image)))
+    if chase_spots is True:
+        print("Chaser detected %d unique spots." % (streamer.chased_spots))
+        print("Held at most %d finished spots in memory (%d runs spilled)." % (streamer.max_held_spots, streamer.spilled_runs))
+    if filter.mask_image_filename is not None:
+        print("Filtered %d spots using a mask image: %s." % (streamer.total_spots - streamer.output_spots, filter.mask_image_filename))
+    print("Output tsv file to %s." % (output_tsv_filename))
+
+    # output marked image (spots are read back from the tsv file)
+    if output_image is True:
+        results = pandas.read_csv(output_tsv_filename, comment = '#', sep = '\t')
+        marker.write_marked_movie(output_image_filename, orig_image, results)
+        print("Output image file to %s." % (output_image_filename))
+
+    print(".")
+    sys.exit()
+
 # fitting and combine all results
 results = tracer.fitting_image_stack(orig_image)
 if len(results) == 0:
     print("No spots detected. Quit.")
     sys.exit()
 
-spot_counts = [len(results[results.plane == i]) for i in range(results.plane.max() + 1)]
+spot_counts = planeindex.PlaneIndex(results).plane_counts
 print("Detected spots: %s" % (' '.join(map(str, spot_counts))))
 print("Total %d spots detected in %d frames." % (len(results), len(orig_image)))
 
@@ -178,14 +247,8 @@ print("Output tsv file to %s." % (output_tsv_filename))
 
 # output marked image
 if output_image is True:
-    # prepare image of 8-bit RGB color
-    image_color = marker.convert_to_color(orig_image)
-
-    # mark tracking status
-    image_color = marker.mark_spots(image_color, results)
-
-    # output multipage tiff
-    tifffile.imwrite(output_image_filename, image_color)
+    # mark tracking status and output multipage tiff (8-bit RGB color) chunk by chunk
+    marker.write_marked_movie(output_image_filename, orig_image, results)
     print("Output image file to %s." % (output_image_filename))
 
 # spacer to next processing